@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""Benchmark of HCTIWS with synthetic styles and sheets
+
+Everything needed is generated in a working directory: one style for each
+item type, PNG assets and CSV sheets of the sizes given. Each case runs in
+a fresh process, so caches start cold and the peak RSS belongs to the case.
+The startup cost is measured separately, as the time to import the module and
+to render a sheet of a single row from the command line.
+"""
+
+import sys
+import os
+import io
+import csv
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import tempfile
+import statistics
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_ROWS = "10,100,1000"
+PAGE_HEIGHT = 20000
+STARTUP_RUNS = 5
+FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+]
+ICONS = ["icon0.png", "icon1.png", "icon2.png", "icon3.png"]
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf",
+         "hotel", "india", "juliett", "kilo", "lima", "mike", "november"]
+
+# item type: (height of background, items of the layout, cells of a row)
+STYLES = {
+    "text": (60, """
+[[row.item]]
+type = "text"
+position = [10, 5]
+width = 380
+height = 50
+[[row.item]]
+type = "text"
+position = [-10, 5]
+width = 380
+height = 50
+horizontal_align = "right"
+""", lambda r: [words(r, 1, 3), words(r, 1, 6)]),
+    "text_compress": (60, """
+[[row.item]]
+type = "text"
+position = [10, 5]
+width = 300
+height = 50
+""", lambda r: [words(r, 4, 10)]),
+    "colortext": (60, """
+[[row.item]]
+type = "colortext"
+position = [10, 5]
+width = 780
+height = 50
+""", lambda r: [r.choice(["red", "#0080ff", "green", "black"]), words(r, 1, 5)]),
+    "vertitext": (220, """
+[[row.item]]
+type = "vertitext"
+position = [10, 10]
+width = 50
+height = 200
+space = 2
+""", lambda r: [r.choice(WORDS)[:r.randint(2, 6)].upper()]),
+    "doubletext": (60, """
+[[row.item]]
+type = "doubletext"
+position = [10, 5]
+width = 780
+height = 50
+space = 10
+minimum_point = 10
+minimum_diff = 4
+maximum_diff = 20
+prior = 0
+horizontal_align_right = "right"
+""", lambda r: [words(r, 1, 4), words(r, 1, 6)]),
+    "doubletext_nl": (110, """
+[[row.item]]
+type = "doubletext_nl"
+position = [10, 5]
+width = 780
+height = 100
+space = 4
+""", lambda r: [words(r, 1, 4), words(r, 1, 6)]),
+    "figure": (60, """
+[[row.item]]
+type = "figure"
+keep_aspect_ratio = 1
+position = [10, 5]
+width = 50
+height = 50
+[[row.item]]
+type = "figure"
+keep_aspect_ratio = 0
+position = [-10, 5]
+width = 100
+height = 50
+""", lambda r: [r.choice(ICONS), r.choice(ICONS)]),
+    "text_plus_fig": (60, """
+[[row.item]]
+type = "text_plus_fig"
+position = [10, 5]
+width = 780
+height = 50
+figure_follow = true
+""", lambda r: [words(r, 1, 4), r.choice(ICONS)]),
+}
+
+
+def words(rand: random.Random, min_count: int, max_count: int) -> str:
+    """Getting some random words"""
+    return " ".join(rand.choice(WORDS) for _ in range(rand.randint(min_count, max_count)))
+
+
+def find_font(workdir: str) -> str:
+    """Getting a TrueType font, the one bundled with Pillow if possible"""
+    from PIL import ImageFont
+    font_file = os.path.join(workdir, "font.ttf")
+    if os.path.exists(font_file):
+        return font_file
+    try:
+        # Pillow 10.1 and later embed a TrueType font for load_default()
+        font_bytes = ImageFont.load_default(10).font_bytes
+    except (TypeError, AttributeError):
+        font_bytes = None
+    if font_bytes is None:
+        for i in FONT_CANDIDATES:
+            if os.path.exists(i):
+                with open(i, "rb") as f:
+                    font_bytes = f.read()
+                break
+        else:
+            raise NameError("No TrueType font found, please put one as " + font_file)
+    with open(font_file, "wb") as f:
+        f.write(font_bytes)
+    return font_file
+
+
+def prepare_workdir(workdir: str, styles: list[str], row_counts: list[int]):
+    """Generating styles, assets and sheets not generated yet"""
+    from PIL import Image, ImageDraw
+    font_file = find_font(workdir)
+    for (i, color) in zip(ICONS, ["red", "green", "blue", "orange"]):
+        if not os.path.exists(os.path.join(workdir, i)):
+            icon = Image.new("RGBA", (64, 64))
+            ImageDraw.Draw(icon).ellipse((4, 4, 60, 60), fill=color)
+            icon.save(os.path.join(workdir, i))
+    for style in styles:
+        (height, items, make_cells) = STYLES[style]
+        style_dir = os.path.join(workdir, "config", "bench_" + style)
+        os.makedirs(style_dir, exist_ok=True)
+        Image.new("RGB", (800, height), "white").save(os.path.join(style_dir, "bg.png"))
+        with open(os.path.join(style_dir, "layout.toml"), "w") as f:
+            f.write("[_meta]\nlayout_version = 2\nmax_width = 800\n")
+            if style == "text_compress":
+                f.write("allow_compress_text = true\ncompress_text_ratio = 0.5\n")
+            f.write("\n[row]\nbackground = \"bg.png\"\n")
+            f.write("[row.default_{}]\nfont = {}\ncolor = \"black\"\n".format(
+                style.split("_compress")[0], json.dumps(font_file)))
+            f.write("horizontal_align = \"left\"\nvertical_align = \"center\"\n")
+            f.write(items)
+        for rows in row_counts:
+            sheet_file = os.path.join(workdir, "sheets", "{}_{}.csv".format(style, rows))
+            if os.path.exists(sheet_file):
+                continue
+            os.makedirs(os.path.dirname(sheet_file), exist_ok=True)
+            rand = random.Random(rows)
+            with open(sheet_file, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["bench_" + style])
+                for j in range(rows):
+                    writer.writerow(["row" if j == 0 else ""] + make_cells(rand))
+
+
+def get_peak_rss() -> int:
+    """Getting the peak RSS of this process in KiB, or None if unknown"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_case(workdir: str, style: str, rows: int, jobs: int) -> dict[str,]:
+    """Rendering a sheet in this process and measuring it"""
+    sys.path.insert(0, BASE_DIR)
+    import hctiws
+    sheet_file = os.path.join(workdir, "sheets", "{}_{}.csv".format(style, rows))
+    renderer = hctiws.Renderer(os.path.join(workdir, "config"),
+                               os.path.dirname(sheet_file), jobs)
+    render_time = 0
+    encode_time = 0
+    output_bytes = 0
+    start_time = time.perf_counter()
+    for (_, s_rows) in hctiws.iter_sheets(sheet_file):
+        (options, images) = renderer.render_sheet_output(s_rows, PAGE_HEIGHT)
+        for img in images:
+            mid_time = time.perf_counter()
+            buffer = io.BytesIO()
+            hctiws.save_image(img, buffer, options)
+            output_bytes += buffer.tell()
+            encode_time += time.perf_counter() - mid_time
+    render_time = time.perf_counter() - start_time - encode_time
+    return {"style": style, "rows": rows, "jobs": jobs,
+            "render_seconds": render_time,
+            "rows_per_second": rows / render_time if render_time else None,
+            "encode_seconds": encode_time, "output_bytes": output_bytes,
+            "peak_rss_kb": get_peak_rss()}
+
+
+def run_case_process(workdir: str, style: str, rows: int, jobs: int) -> dict[str,]:
+    """Running a case in a new process"""
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", workdir,
+                           style, str(rows), str(jobs)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        return {"style": style, "rows": rows, "jobs": jobs,
+                "error": proc.stderr.strip().splitlines()[-1]}
+    return json.loads(proc.stdout)
+
+
+def run_startup(workdir: str, runs: int) -> dict[str,]:
+    """Measuring the median startup times in milliseconds with new processes"""
+    prepare_workdir(workdir, ["text"], [1])
+    sheet_file = os.path.join(workdir, "sheets", "text_1.csv")
+    output_dir = os.path.join(workdir, "startup")
+    os.makedirs(output_dir, exist_ok=True)
+    commands = {
+        "python_ms": [sys.executable, "-c", "pass"],
+        "import_ms": [sys.executable, "-c", "import hctiws"],
+        "first_image_ms": [sys.executable, os.path.join(BASE_DIR, "hctiws.py"),
+                           sheet_file, output_dir],
+    }
+    ret = {}
+    for (i, j) in commands.items():
+        times = []
+        for _ in range(runs):
+            start_time = time.perf_counter()
+            # the output name is probed, so the image of the last run is removed
+            for k in os.listdir(output_dir):
+                os.remove(os.path.join(output_dir, k))
+            subprocess.run(j, cwd=BASE_DIR if i == "import_ms" else workdir,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           check=True)
+            times.append((time.perf_counter() - start_time) * 1000)
+        ret[i] = statistics.median(times)
+    return ret
+
+
+def print_startup(startup: dict[str,], baseline=None, budget=None):
+    """Printing the startup times, comparing with the baseline if given"""
+    old = (baseline or {}).get("startup") or {}
+    for (i, j) in (("python_ms", "python"), ("import_ms", "import hctiws"),
+                   ("first_image_ms", "single row sheet")):
+        compare = ""
+        if old.get(i):
+            compare = "  {:+.1%}".format(startup[i] / old[i] - 1)
+        print("{:<20}{:>10.1f} ms{}".format(j, startup[i], compare))
+    if budget is not None:
+        print("{:<20}{:>10.1f} ms  {}".format(
+            "budget", budget, "OK" if startup["first_image_ms"] <= budget else "EXCEEDED"))
+
+
+def print_results(results: list[dict[str,]], baseline=None):
+    """Printing the results as a table, comparing with the baseline if given"""
+    old = {}
+    if baseline is not None:
+        old = {(i["style"], i["rows"], i["jobs"]): i for i in baseline["cases"]}
+    print("{:<15}{:>8}{:>5}{:>11}{:>12}{:>10}{:>12}{:>11}{}".format(
+        "style", "rows", "jobs", "render s", "rows/s", "encode s", "output KiB",
+        "peak MiB", "  vs baseline" if old else ""))
+    for i in results:
+        if "error" in i:
+            print("{:<15}{:>8}{:>5}  FAILED {}".format(i["style"], i["rows"], i["jobs"],
+                                                      i["error"]))
+            continue
+        compare = ""
+        j = old.get((i["style"], i["rows"], i["jobs"]))
+        if j is not None and "error" not in j:
+            compare = "  {:+.1%}".format(j["render_seconds"] / i["render_seconds"] - 1)
+        print("{:<15}{:>8}{:>5}{:>11.3f}{:>12.1f}{:>10.3f}{:>12.1f}{:>11}{}".format(
+            i["style"], i["rows"], i["jobs"], i["render_seconds"], i["rows_per_second"],
+            i["encode_seconds"], i["output_bytes"] / 1024,
+            "-" if i["peak_rss_kb"] is None else "{:.1f}".format(i["peak_rss_kb"] / 1024),
+            compare))
+
+
+def main(argv=None):
+    """Main function of the benchmark"""
+    if argv is None:
+        argv = sys.argv
+    if len(argv) == 6 and argv[1] == "--case":
+        print(json.dumps(run_case(argv[2], argv[3], int(argv[4]), int(argv[5]))))
+        return 0
+    parser = argparse.ArgumentParser(description="Benchmark of HCTIWS")
+    parser.add_argument("--rows", default=DEFAULT_ROWS,
+                        help="comma separated row counts (default: " + DEFAULT_ROWS + ")")
+    parser.add_argument("--styles", default=",".join(STYLES),
+                        help="comma separated styles (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="processes used by each case (default: 1)")
+    parser.add_argument("--workdir",
+                        help="directory of generated files, kept for later runs "
+                        "(default: a temporary directory)")
+    parser.add_argument("-o", "--output", help="save the results as JSON")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="compare render times with results saved before")
+    parser.add_argument("--startup-runs", type=int, default=STARTUP_RUNS, metavar="N",
+                        help="runs of measuring the startup, 0 to skip (default: {})".format(
+                            STARTUP_RUNS))
+    parser.add_argument("--startup-budget", type=float, metavar="MS",
+                        help="fail if rendering a single row sheet takes longer")
+    args = parser.parse_args(argv[1:])
+    styles = args.styles.split(",")
+    for i in styles:
+        if i not in STYLES:
+            parser.error("unknown style " + i)
+    row_counts = [int(i) for i in args.rows.split(",")]
+
+    tmp_dir = None
+    if args.workdir is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="hctiws-bench-")
+        workdir = tmp_dir.name
+    else:
+        workdir = os.path.abspath(args.workdir)
+        os.makedirs(workdir, exist_ok=True)
+    prepare_workdir(workdir, styles, row_counts)
+    results = []
+    for style in styles:
+        for rows in row_counts:
+            results.append(run_case_process(workdir, style, rows, args.jobs))
+    startup = None
+    if args.startup_runs > 0:
+        startup = run_startup(workdir, args.startup_runs)
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if startup is not None:
+        print()
+        print_startup(startup, baseline, args.startup_budget)
+    if args.output is not None:
+        import PIL
+        with open(args.output, "w") as f:
+            json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(),
+                       "pillow": PIL.__version__,
+                       "platform": platform.platform(),
+                       "cases": results, "startup": startup}, f, indent=2)
+    if startup is not None and args.startup_budget is not None \
+            and startup["first_image_ms"] > args.startup_budget:
+        return 1
+    return 1 if any("error" in i for i in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
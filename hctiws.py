@@ -1,43 +1,393 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
 import sys
 import os
-import csv
-from typing import Tuple
-import toml
-import xlrd
-from PIL import Image, ImageFont, ImageDraw
+import time
+import io
+import json
+import threading
+import heapq
+import contextlib
+import contextvars
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Tuple
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field
+import functools
+from PIL import Image, ImageColor
 import math
 
+# Other dependencies are imported where they are needed, since most runs only
+# use a few of them and the command line is often called for small sheets.
+if TYPE_CHECKING:
+    import argparse
+    from PIL import ImageFont
+
 COMPRESS_BASE_IMAGE_MULTIPLE = 5
+COMPRESS_TEXT_QUALITIES = ("high", "fast")
+FONT_CACHE_SIZE = 256
+TEXT_EXTENT_CACHE_SIZE = 65536
+BACKGROUND_CACHE_BYTES = 256 * 1024 * 1024
+FIGURE_CACHE_BYTES = 128 * 1024 * 1024
+TEXT_SPRITE_CACHE_BYTES = 64 * 1024 * 1024
+SECTION_CACHE_BYTES = 64 * 1024 * 1024
+SPREADSHEET_EXTENSIONS = (".csv", ".xlsx", ".xls")
+STYLE_CACHE_VERSION = 2
+SECTION_CHUNK_SIZE = 8
+TILE_CACHE_VERSION = 1
+TILE_CACHE_DIRNAME = ".hctiws_cache"
+PROFILE_SLOWEST = 10
+PROFILE_MAX_EVENTS = 1000000
+OUTPUT_FORMATS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+
+
+class ImageCache:
+    """LRU cache of decoded images bounded by their memory usage"""
+
+    def __init__(self, max_bytes: int, name="image"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.cur_bytes = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def image_bytes(img: Image.Image) -> int:
+        """Estimating the memory used by an image"""
+        return img.size[0] * img.size[1] * len(img.getbands())
+
+    def get(self, key):
+        """Getting an item and marking it as recently used"""
+        with self.lock:
+            ret = self.items.get(key)
+            if ret is not None:
+                self.items.move_to_end(key)
+        profile_count(self.name + ("_cache_miss" if ret is None else "_cache_hit"))
+        return None if ret is None else ret[0]
+
+    def put(self, key, value, *images: Image.Image):
+        """Putting an item, the images given are counted as its size"""
+        nbytes = sum(self.image_bytes(i) for i in images)
+        with self.lock:
+            if key in self.items:
+                self.cur_bytes -= self.items.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self.items[key] = (value, nbytes)
+            self.cur_bytes += nbytes
+            while self.cur_bytes > self.max_bytes:
+                self.cur_bytes -= self.items.popitem(last=False)[1][1]
+
+    def clear(self):
+        """Removing all items"""
+        with self.lock:
+            self.items.clear()
+            self.cur_bytes = 0
+
+
+class Instrument:
+    """Hooks receiving timings and counters of rendering, doing nothing by default
+
+    Override the hooks and activate the instance with instrument(). Times are
+    in seconds of time.perf_counter(). Rows rendered by worker processes of
+    parallel rendering are not reported.
+    """
+
+    def on_span(self, name: str, category: str, start: float,
+                duration: float, args: dict[str,]):
+        """Receiving the time of a stage ("stage"), row ("row") or item ("item")"""
+
+    def on_count(self, name: str, n: int):
+        """Receiving the increment of a counter"""
+
+
+_instrument = contextvars.ContextVar("hctiws_instrument", default=None)
+_no_span = contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def instrument(hook: Instrument) -> Iterator[Instrument]:
+    """Activating the hooks in the current thread, or disabling them if None
+
+    Background threads started meanwhile by this module inherit the hooks.
+    """
+    token = _instrument.set(hook)
+    try:
+        yield hook
+    finally:
+        _instrument.reset(token)
+
+
+class _Span:
+    """Timing a block for the active hooks"""
+    __slots__ = ("hook", "name", "category", "args", "start")
+
+    def __init__(self, hook: Instrument, name: str, category: str, args: dict[str,]):
+        self.hook = hook
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.hook.on_span(self.name, self.category, self.start,
+                          time.perf_counter() - self.start, self.args)
+
+
+def profile_span(name: str, category="stage", **args):
+    """Timing a block if hooks are active, args are passed to the hooks"""
+    hook = _instrument.get()
+    if hook is None:
+        return _no_span
+    return _Span(hook, name, category, args)
+
+
+def profile_count(name: str, n=1):
+    """Increasing a counter if hooks are active"""
+    hook = _instrument.get()
+    if hook is not None:
+        hook.on_count(name, n)
+
+
+class Profiler(Instrument):
+    """Collecting timings and counters into a summary and a Chrome trace"""
+
+    def __init__(self, slowest=PROFILE_SLOWEST, max_events=PROFILE_MAX_EVENTS):
+        self.slowest = slowest
+        self.max_events = max_events
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.slowest_spans = {"row": [], "item": []}
+        self.events = []
+        self.seq = 0
+        self.lru_base = self.get_lru_info()
+
+    @staticmethod
+    def get_lru_info() -> dict[str, Tuple[int, int]]:
+        """Getting hits and misses of the font and text extent caches"""
+        return {i.__name__: tuple(i.cache_info()[:2])
+                for i in (load_font, get_text_extent, fit_text, fit_doubletext)}
+
+    def on_span(self, name: str, category: str, start: float,
+                duration: float, args: dict[str,]):
+        with self.lock:
+            stat = self.stages.setdefault((category, name), [0, 0.0])
+            stat[0] += 1
+            stat[1] += duration
+            if category in self.slowest_spans:
+                self.seq += 1
+                heap = self.slowest_spans[category]
+                heapq.heappush(heap, (duration, self.seq, name, args))
+                if len(heap) > self.slowest:
+                    heapq.heappop(heap)
+            if len(self.events) < self.max_events:
+                self.events.append({
+                    "name": name, "cat": category, "ph": "X",
+                    "ts": (start - self.origin) * 1e6, "dur": duration * 1e6,
+                    "pid": os.getpid(), "tid": threading.get_ident(),
+                    "args": {i: str(j) for (i, j) in args.items()}})
+
+    def on_count(self, name: str, n: int):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def get_summary(self) -> str:
+        """Getting the tables of stages, counters and the slowest rows and items"""
+        lines = ["{:<8}{:<28}{:>10}{:>12}{:>12}".format(
+            "kind", "stage", "count", "total s", "mean ms")]
+        for ((i, j), (count, total)) in sorted(self.stages.items(),
+                                               key=lambda x: -x[1][1]):
+            lines.append("{:<8}{:<28}{:>10}{:>12.3f}{:>12.3f}".format(
+                i, j, count, total, total / count * 1000))
+        counters = dict(self.counters)
+        for (i, (hits, misses)) in self.get_lru_info().items():
+            counters[i + "_cache_hit"] = hits - self.lru_base[i][0]
+            counters[i + "_cache_miss"] = misses - self.lru_base[i][1]
+        lines.append("\n{:<48}{:>12}{:>10}".format("counter", "count", "hit rate"))
+        for i in sorted(counters):
+            rate = ""
+            if i.endswith("_cache_hit"):
+                total = counters[i] + counters.get(i[:-3] + "miss", 0)
+                rate = "{:.1%}".format(counters[i] / total) if total else ""
+            lines.append("{:<48}{:>12}{:>10}".format(i, counters[i], rate))
+        for (i, heap) in self.slowest_spans.items():
+            if not heap:
+                continue
+            lines.append("\nslowest {}s".format(i))
+            for (duration, _, name, args) in sorted(heap, reverse=True):
+                lines.append("{:>10.3f} ms  {} {}".format(
+                    duration * 1000, name,
+                    " ".join("{}={!r}".format(k, l) for (k, l) in args.items())))
+        return "\n".join(lines)
+
+    def save_trace(self, fp):
+        """Saving the spans to a filename or file object in Chrome trace format"""
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        if isinstance(fp, str):
+            with open(fp, "w") as f:
+                json.dump(trace, f)
+        else:
+            json.dump(trace, fp)
+
+
+# The caches are shared by all renderers and threads. Keys only contain
+# absolute paths, and cached images are never drawn on directly.
+_path_index = {}
+_style_cache = {}
+_background_cache = ImageCache(BACKGROUND_CACHE_BYTES, "background")
+_figure_cache = ImageCache(FIGURE_CACHE_BYTES, "figure")
+_text_sprite_cache = ImageCache(TEXT_SPRITE_CACHE_BYTES, "text_sprite")
+
+
+def clear_caches():
+    """Clearing all cached paths, fonts and images of this run"""
+    _path_index.clear()
+    _style_cache.clear()
+    _background_cache.clear()
+    _figure_cache.clear()
+    _text_sprite_cache.clear()
+    load_font.cache_clear()
+    get_text_extent.cache_clear()
+    fit_text.cache_clear()
+    fit_doubletext.cache_clear()
 
-def find_file(filename: str, style_dir="") -> str:
+
+@dataclass
+class RenderContext:
+    """Settings of the sheet being rendered, shared by all item types"""
+    style_dir: str
+    input_dir: str = ""
+    meta: dict[str,] = field(default_factory=dict)
+    max_width: int = 0
+    default_color: str = "black"
+    allow_compress_text: bool = False
+    compress_text_ratio: float = 1
+    compress_text_quality: str = "high"
+
+    @classmethod
+    def from_style(cls, style: dict[str,], style_dir: str, input_dir=""):
+        """Loading meta configs of the style"""
+        ctx = cls(os.path.abspath(style_dir), input_dir, style.get("_meta", {}))
+        if ("max_width" in ctx.meta):
+            ctx.max_width = ctx.meta["max_width"]
+        if ("default_color" in ctx.meta):
+            ctx.default_color = ctx.meta["default_color"]
+        if ("allow_compress_text" in ctx.meta and "compress_text_ratio" in ctx.meta):
+            ctx.allow_compress_text = ctx.meta["allow_compress_text"]
+            ctx.compress_text_ratio = ctx.meta["compress_text_ratio"]
+            if ((not ctx.allow_compress_text)
+                or (type(ctx.compress_text_ratio) != int
+                    and type(ctx.compress_text_ratio) != float)
+                or ctx.compress_text_ratio > 1
+                or ctx.compress_text_ratio < 0):
+                ctx.compress_text_ratio = 1
+        if ("compress_text_quality" in ctx.meta):
+            ctx.compress_text_quality = ctx.meta["compress_text_quality"]
+        return ctx
+
+
+def find_file(filename: str, ctx: RenderContext) -> str:
     """Finding file in possible directories"""
-    tmp_filename = os.path.join(INPUT_DIR, filename)
-    if os.path.exists(tmp_filename):
-        return tmp_filename
-    tmp_filename = os.path.join(style_dir, filename)
-    if os.path.exists(tmp_filename):
-        return tmp_filename
-    tmp_filename = os.path.join(os.path.dirname(
-        os.path.dirname(os.getcwd())), filename)
-    if os.path.exists(tmp_filename):
-        return tmp_filename
-    raise NameError("File not found")
-
-
-def get_style(style_name: str) -> dict[str,]:
-    """Getting the style information"""
-    style_filename = os.path.join("config", style_name, "layout.")
+    key = (ctx.input_dir, ctx.style_dir, filename)
+    if key not in _path_index:
+        ret = None
+        # input directory, style directory, then the one containing "config"
+        for i in (ctx.input_dir, ctx.style_dir,
+                  os.path.dirname(os.path.dirname(ctx.style_dir))):
+            tmp_filename = os.path.join(i, filename)
+            if os.path.exists(tmp_filename):
+                ret = tmp_filename
+                break
+        _path_index[key] = ret
+    if _path_index[key] is None:
+        raise NameError("File not found")
+    return _path_index[key]
+
+
+def find_figure(filename: str, ctx: RenderContext) -> str:
+    """Finding figure file, including the aliases in the style"""
+    try:
+        return find_file(filename, ctx)
+    except NameError:
+        return os.path.join(ctx.style_dir, ctx.meta["figure_alias"][filename])
+
+
+def load_background(filename: str, ctx: RenderContext) -> Image.Image:
+    """Loading the background image, the copy returned can be drawn on"""
+    key = os.path.abspath(find_file(filename, ctx))
+    bg_img = _background_cache.get(key)
+    if bg_img is None:
+        with profile_span("decode_background", file=key):
+            bg_img = Image.open(key)
+            bg_img.load()
+        _background_cache.put(key, bg_img, bg_img)
+    return bg_img.copy()
+
+
+def load_figure(filename: str, box: Tuple[int, int],
+                keep_aspect_ratio=1) -> Tuple[Image.Image, Image.Image]:
+    """Loading the figure resized to the box, and its RGBA version as mask"""
+    key = (os.path.abspath(filename), tuple(box), bool(keep_aspect_ratio))
+    ret = _figure_cache.get(key)
+    if ret is None:
+        with profile_span("decode_figure", file=key[0]):
+            fig: Image.Image = Image.open(filename)
+            if keep_aspect_ratio:
+                fig.thumbnail(box)
+            else:
+                fig = fig.resize(box)
+            ret = (fig, fig.convert("RGBA"))
+        _figure_cache.put(key, ret, *ret)
+    return ret
+
+
+def find_style_file(style_name: str, config_dir="config") -> str:
+    """Finding the layout file of the style"""
+    style_filename = os.path.join(config_dir, style_name, "layout.")
     if os.path.exists(style_filename + "toml"):
-        style_filename += "toml"
+        return style_filename + "toml"
     elif os.path.exists(style_filename + "ini"):
-        style_filename += "ini"
+        return style_filename + "ini"
     else:
         raise NameError("Layout file not found")
+
+
+def load_toml(filename: str) -> dict[str,]:
+    """Parsing the TOML file, with tomllib of Python 3.11 and later if possible"""
+    error = None
+    try:
+        import tomllib
+    except ImportError:
+        tomllib = None
+    if tomllib is not None:
+        with open(filename, "rb") as f:
+            try:
+                return tomllib.load(f)
+            except tomllib.TOMLDecodeError as e:
+                error = e
+    # the toml package also accepts some files written for older versions
+    try:
+        import toml
+    except ImportError:
+        if error is not None:
+            raise error
+        raise ImportError("Reading layout files needs Python 3.11 or later, "
+                          "or the toml package")
+    return toml.load(filename)
+
+
+def get_style(style_name: str, config_dir="config") -> dict[str,]:
+    """Getting the style information"""
+    style_filename = find_style_file(style_name, config_dir)
     
     # some compatibility stuff
-    ret = toml.load(style_filename)
+    ret = load_toml(style_filename)
     if "_meta" not in ret:
         ret["_meta"] = { "layout_version": 0 }
     elif "version" not in ret["_meta"]:
@@ -49,122 +399,224 @@ def get_style(style_name: str) -> dict[str,]:
     return ret
 
 
-def get_text_size(text: str, font: str, size: list[int], offset=0,
-                  enable_compress = False) -> Tuple[ImageFont.ImageFont]:
-    """Getting the proper size in point of the text"""
-    tmp_size1 = size[1]
-    tmp_font = ImageFont.truetype(font, tmp_size1)
-    # while tmp_font.getsize(text)[0] <= size[0] and \
-    #        tmp_font.getsize(tmp_text)[1] <= size[1] / (1 - offset):
-    #    tmp_size += 1
-    #    tmp_font = ImageFont.truetype(font, tmp_size)
-    #tmp_size -= 1
-    #tmp_font = ImageFont.truetype(font, tmp_size)
-    #print (text, " ", tmp_size, " ", size)
-    if (enable_compress and allow_compress_text):
-        if (tmp_font.getsize(text)[0] > size[0]):
-            tmp_size1 *= COMPRESS_BASE_IMAGE_MULTIPLE
-            tmp_font = ImageFont.truetype(font, tmp_size1)
-            return (tmp_font, tmp_size1, True)
-        else:
-            return (tmp_font, tmp_size1, False)
-    else:
-        while tmp_font.getsize(text)[0] > size[0]:
-            if tmp_size1 == 1:
-                break
-            tmp_size1 -= 1
-            tmp_font = ImageFont.truetype(font, tmp_size1)
-        return (tmp_font, tmp_size1, False)
-    # the last boolean value indicates that the text needs to be compressed
-
-def draw_text(s_img: Image.Image,
-              text: str, font: str, color: str,
-              pos: list[int], size: list[int],
-              h_align="left", v_align="top",
-              offset=0) -> Tuple[Image.Image, list[int], list[int]]:
-    """Drawing the text to the image"""
-    new_img = s_img
+def find_font(font: str, ctx: RenderContext) -> str:
+    """Finding font file, falling back to the name for system fonts"""
     try:
-        font_loc = find_file(font)
+        return find_file(font, ctx)
     except NameError:
-        font_loc = font
-    get_text_size_ret = get_text_size(text, font_loc, size, offset, True)
-    tmp_font = get_text_size_ret[0]
-    need_compress = get_text_size_ret[2]
+        return font
 
-    if (need_compress):
-        large_text_size = tmp_font.getsize(text)
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font: str, size: int) -> ImageFont.FreeTypeFont:
+    """Loading the font in given size, shared by all item types"""
+    from PIL import ImageFont
+    with profile_span("load_font", font=font, size=size):
+        return ImageFont.truetype(font, size)
+
+
+@functools.lru_cache(maxsize=TEXT_EXTENT_CACHE_SIZE)
+def get_text_extent(text: str, font: str, size: int) -> Tuple[int, int]:
+    """Getting the width and height of the text in given font size"""
+    tmp_font = load_font(font, size)
+    if hasattr(tmp_font, "getsize"):
+        return tuple(tmp_font.getsize(text))
+    # Pillow 10 removed getsize(), whose result is the right-bottom of getbbox()
+    bbox = tmp_font.getbbox(text)
+    return (bbox[2], bbox[3])
+
+
+def fit_font_size(text: str, font: str, width: int, max_size: int) -> int:
+    """Finding the largest size (but at least 1) in which the text fits the width"""
+    if max_size <= 1 or get_text_extent(text, font, max_size)[0] <= width:
+        return max_size
+    # the width never decreases when size grows, so bisect in [1, max_size)
+    low, high = 1, max_size
+    while high - low > 1:
+        profile_count("fit_iteration")
+        mid = (low + high) // 2
+        if get_text_extent(text, font, mid)[0] <= width:
+            low = mid
+        else:
+            high = mid
+    return low
+
+
+@functools.lru_cache(maxsize=TEXT_EXTENT_CACHE_SIZE)
+def fit_text(text: str, font: str, width: int, height: int,
+             enable_compress=False) -> Tuple[int, bool]:
+    """Getting the size of the text in the box, and whether it is compressed"""
+    if (enable_compress):
+        if (get_text_extent(text, font, height)[0] > width):
+            return (height * COMPRESS_BASE_IMAGE_MULTIPLE, True)
+        return (height, False)
+    return (fit_font_size(text, font, width, height), False)
+
+
+@functools.lru_cache(maxsize=TEXT_EXTENT_CACHE_SIZE)
+def fit_doubletext(major: str, minor: str, font: str, width: int, height: int,
+                   space: int, minimum_point: int, minimum_diff: int,
+                   maximum_diff: int) -> Tuple[int, int]:
+    """Getting the sizes of both texts of 'doubletext'
+
+    The major size is the largest one, not above its own fit, with which the
+    minor text fitted into the remaining width is at least minimum_point and
+    at most maximum_diff smaller. A larger major size never leaves more width,
+    so the valid sizes are all below some size, which is found by bisection.
+    """
+    def get_minor_size(major_size: int) -> int:
+        major_width = get_text_extent(major, font, major_size)[0]
+        return fit_font_size(minor, font, width - major_width - space, height)
+
+    def is_valid(major_size: int) -> bool:
+        profile_count("fit_iteration")
+        minor_size = get_minor_size(major_size)
+        return minor_size >= minimum_point and major_size - minor_size <= maximum_diff
+
+    major_size = fit_font_size(major, font, width, height)
+    if not is_valid(major_size):
+        if major_size <= 1 or not is_valid(1):
+            raise NameError("\"{}\" and \"{}\" can't fit in doubletext".format(
+                major, minor))
+        low, high = 1, major_size
+        while high - low > 1:
+            mid = (low + high) // 2
+            if is_valid(mid):
+                low = mid
+            else:
+                high = mid
+        major_size = low
+    minor_size = get_minor_size(major_size)
+    if major_size - minor_size <= minimum_diff:
+        minor_size = max(minimum_point, major_size - minimum_diff)
+    return (major_size, minor_size)
+
+
+def get_text_mask(text: str, font: str, size: int,
+                  start: Tuple[float, float]) -> Tuple[Image.Image, int, int]:
+    """Getting the coverage of the text drawn from the fractional start, and its padding
+
+    Pasting a color through the mask gives the same pixels as drawing the
+    text, so repeated texts are only rasterized once.
+    """
+    from PIL import ImageDraw
+    key = (text, font, size, start)
+    ret = _text_sprite_cache.get(key)
+    if ret is None:
+        tmp_font = load_font(font, size)
+        bbox = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox(start, text, font=tmp_font)
+        pad_x = max(0, -math.floor(bbox[0])) + 1
+        pad_y = max(0, -math.floor(bbox[1])) + 1
+        mask = Image.new("L", (pad_x + math.ceil(bbox[2]) + 2,
+                               pad_y + math.ceil(bbox[3]) + 2))
+        ImageDraw.Draw(mask).text((pad_x + start[0], pad_y + start[1]), text,
+                                  fill=255, font=tmp_font)
+        ret = (mask, pad_x, pad_y)
+        _text_sprite_cache.put(key, ret, mask)
+    return ret
+
+
+def paste_text(s_img: Image.Image, pos: list[float], text: str,
+               font: str, size: int, color: str):
+    """Drawing the text to the image, reusing its mask if possible"""
+    from PIL import ImageDraw
+    # multiline texts and negative positions are laid out differently by Pillow
+    if s_img.mode not in ("RGB", "RGBA", "L") or pos[0] < 0 or pos[1] < 0 \
+            or "\n" in text or not hasattr(ImageDraw.ImageDraw, "textbbox"):
+        ImageDraw.Draw(s_img).text(pos, text, fill=color, font=load_font(font, size))
+        return
+    (mask, pad_x, pad_y) = get_text_mask(text, font, size,
+                                         (math.modf(pos[0])[0], math.modf(pos[1])[0]))
+    s_img.paste(color, (int(pos[0]) - pad_x, int(pos[1]) - pad_y), mask)
+
+
+def get_compressed_text(text: str, font: str, size: int, color: str,
+                        box: Tuple[int, int], offset: float, ratio: float,
+                        quality="high") -> Tuple[Image.Image, list[float]]:
+    """Getting the text compressed into the box, and its size
+
+    The "high" quality renders the text at the large size and shrinks it,
+    while "fast" renders it at about the final height and only shrinks the
+    width, which takes a small fraction of the pixels.
+    """
+    from PIL import ImageDraw
+    key = ("compressed", text, font, size, color, box, offset, ratio, quality)
+    ret = _text_sprite_cache.get(key)
+    if ret is None:
+        large_text_size = get_text_extent(text, font, size)
         large_text_size = (math.ceil(large_text_size[0]), math.ceil(large_text_size[1]))
-        tmp_canvas = Image.new("RGBA", large_text_size)
-        text += "　" #for Source Han Sans
-        if (color == None or color == ""):
-            color = default_color
-        ImageDraw.Draw(tmp_canvas).text((0, 0), text, fill=color, font=tmp_font)
         #size1_add_offset = size[1] / (1 - offset)
         # Please not the offset support in COMPRESSED TEXT still has issues in this version
-        if (large_text_size[0] * compress_text_ratio / large_text_size[1] > size[0] / size[1]):
-            new_canvas_size = (size[0],
-                         math.floor(size[0] / compress_text_ratio * (large_text_size[1] / large_text_size[0])))
+        if (large_text_size[0] * ratio / large_text_size[1] > box[0] / box[1]):
+            new_canvas_size = (box[0],
+                         math.floor(box[0] / ratio * (large_text_size[1] / large_text_size[0])))
             text_size = [new_canvas_size[0], new_canvas_size[1] * (1 - offset)]
         else:
-            new_canvas_size = (min(size[0], math.ceil(size[1] / large_text_size[1] * large_text_size[0])), size[1])
-            text_size = [new_canvas_size[0], size[1]]
-        tmp_canvas = tmp_canvas.resize(new_canvas_size)
+            new_canvas_size = (min(box[0], math.ceil(box[1] / large_text_size[1] * large_text_size[0])), box[1])
+            text_size = [new_canvas_size[0], box[1]]
+        if quality == "fast":
+            small_size = max(1, round(size * new_canvas_size[1] / large_text_size[1]))
+            tmp_canvas = Image.new("RGBA", (math.ceil(get_text_extent(text, font, small_size)[0]),
+                                            new_canvas_size[1]))
+            ImageDraw.Draw(tmp_canvas).text((0, 0), text + "　", fill=color,
+                                            font=load_font(font, small_size))
+        else:
+            tmp_canvas = Image.new("RGBA", large_text_size)
+            ImageDraw.Draw(tmp_canvas).text((0, 0), text + "　", fill=color,
+                                            font=load_font(font, size))
+        ret = (tmp_canvas.resize(new_canvas_size), text_size)
+        _text_sprite_cache.put(key, ret, ret[0])
+    return (ret[0], list(ret[1]))
+
+def draw_text(s_img: Image.Image, ctx: RenderContext,
+              text: str, font: str, color: str,
+              pos: list[int], size: list[int],
+              anchor=(0, 0), offset=0) -> Tuple[Image.Image, list[int], list[int]]:
+    """Drawing the text to the image
 
-        if (pos[0] < 0 and max_width != 0):
-            pos[0] = max_width + pos[0] - size[0]
-        tmp_pos = [pos[0], pos[1] - tmp_font.getsize(text)[1] * offset]
+    The font is a resolved filename, and pos is resolved against max_width
+    already. anchor is the fraction of the space left in the box put before
+    the text, horizontally and vertically.
+    """
+    (tmp_size, need_compress) = fit_text(text, font, size[0], size[1],
+                                         bool(ctx.allow_compress_text))
+    if (color == None or color == ""):
+        color = ctx.default_color
 
-        if h_align == "center":
-            tmp_pos[0] += (size[0] - text_size[0]) / 2
-        elif h_align == "right":
-            tmp_pos[0] += size[0] - text_size[0]
-        if v_align == "center":
-            tmp_pos[1] += (size[1] - text_size[1]) / 2
-        elif v_align == "bottom":
-            tmp_pos[1] += size[1] - text_size[1]
-        
-        actual_pos = (int(tmp_pos[0]), int(tmp_pos[1]))
-        new_img.paste(tmp_canvas, actual_pos, tmp_canvas)
-        return (new_img, actual_pos, text_size)
+    if (need_compress):
+        (tmp_canvas, text_size) = get_compressed_text(
+            text, font, tmp_size, color, tuple(size), offset,
+            ctx.compress_text_ratio, ctx.compress_text_quality)
+        tmp_pos = [pos[0], pos[1] - get_text_extent(text + "　", font, tmp_size)[1] * offset]
     else:
-        text_size = [tmp_font.getsize(text)[0],
-                    tmp_font.getsize(text)[1] * (1 - offset)]
+        single_size = get_text_extent(text, font, tmp_size)
+        text_size = [single_size[0], single_size[1] * (1 - offset)]
+        tmp_pos = [pos[0], pos[1] - single_size[1] * offset]
+    if anchor[0]:
+        tmp_pos[0] += (size[0] - text_size[0]) * anchor[0]
+    if anchor[1]:
+        tmp_pos[1] += (size[1] - text_size[1]) * anchor[1]
 
-        if (pos[0] < 0 and max_width != 0):
-            pos[0] = max_width + pos[0] - size[0]
-        tmp_pos = [pos[0], pos[1] - tmp_font.getsize(text)[1] * offset]
-
-        if h_align == "center":
-            tmp_pos[0] += (size[0] - text_size[0]) / 2
-        elif h_align == "right":
-            tmp_pos[0] += size[0] - text_size[0]
-        if v_align == "center":
-            tmp_pos[1] += (size[1] - text_size[1]) / 2
-        elif v_align == "bottom":
-            tmp_pos[1] += size[1] - text_size[1]
-        text += "　" #for Source Han Sans
-        #if all(ord(c) < 128 for c in text): #for Source Han Sans
-        #    tmp_pos[1] -= 2
-        if (color == None or color == ""):
-            color = default_color
-        ImageDraw.Draw(new_img).text(tmp_pos, text, fill=color, font=tmp_font)
-        #print (tmp_size," ",text_size," ", size[0],"*",size[1])
-        return (new_img, tmp_pos, text_size)
+    if (need_compress):
+        actual_pos = (int(tmp_pos[0]), int(tmp_pos[1]))
+        s_img.paste(tmp_canvas, actual_pos, tmp_canvas)
+        return (s_img, actual_pos, text_size)
+    #if all(ord(c) < 128 for c in text): #for Source Han Sans
+    #    tmp_pos[1] -= 2
+    paste_text(s_img, tmp_pos, text + "　", font, tmp_size, color) #for Source Han Sans
+    return (s_img, tmp_pos, text_size)
 
 
 def generate_text(s_img: Image.Image,
                   item_list: list[str],
                   index: int,
                   para_list: dict[str,],
-                  meta_conf: dict[str,]) -> Tuple[Image.Image, int]:
+                  ctx: RenderContext) -> Tuple[Image.Image, int]:
     """Generating image of 'text' type"""
-    #print(index, ",", para_list["position"])
-    (new_img, _, _) = draw_text(s_img, item_list[index],
-                        para_list["font"], para_list["color"], para_list["position"],
-                        [para_list["width"], para_list["height"]],
-                        para_list["horizontal_align"],
-                        para_list["vertical_align"], para_list.get("offset", 0))
+    box = para_list["box"]
+    (new_img, _, _) = draw_text(s_img, ctx, item_list[index],
+                        para_list["font"], para_list["color"], box[:2], box[2:],
+                        para_list["anchor"], para_list["offset"])
     return (new_img, index + 1)
 
 
@@ -172,82 +624,87 @@ def generate_colortext(s_img: Image.Image,
                        item_list: list[str],
                        index: int,
                        para_list: dict[str,],
-                       meta_conf: dict[str,]) -> Tuple[Image.Image, int]:
+                       ctx: RenderContext) -> Tuple[Image.Image, int]:
     """Generating image of 'colortext' type"""
-    (new_img, _, _) = draw_text(s_img, item_list[index + 1],
-                        para_list["font"], item_list[index], para_list["position"],
-                        [para_list["width"], para_list["height"]],
-                        para_list["horizontal_align"],
-                        para_list["vertical_align"], para_list.get("offset", 0))
+    box = para_list["box"]
+    (new_img, _, _) = draw_text(s_img, ctx, item_list[index + 1],
+                        para_list["font"], item_list[index], box[:2], box[2:],
+                        para_list["anchor"], para_list["offset"])
     return (new_img, index + 2)
 
 
+def layout_vertitext(text: str, font: str, width: int, height: int, space: int,
+                     offset=0, h_align="left",
+                     v_align="top") -> Tuple[int, list[Tuple[str, float, float]]]:
+    """Getting the size of a vertical text, and the position of each character in its box
+
+    All characters share the largest size in which every one of them fits the
+    width and its share of the height, and each of them is measured once in
+    that size.
+    """
+    size = min(fit_font_size(i, font, width, int(height / len(text))) for i in text)
+    extents = [get_text_extent(i, font, size) for i in text]
+    v_step = []
+    text_height = 0
+    for (i, j) in zip(text, extents):
+        v_step.append(j[1] * (1 - offset))
+        text_height += v_step[-1]
+        if i != text[-1]:
+            text_height += space
+            v_step[-1] += space
+    if v_align == "center":
+        cur_v_pos = int((height - text_height) / 2)
+    elif v_align == "bottom":
+        cur_v_pos = height - text_height
+    else:
+        cur_v_pos = 0
+    ret = []
+    for (i, j, k) in zip(text, extents, v_step):
+        # each character is centered in its step, as a line of text
+        h_pos = 0
+        if h_align == "center":
+            h_pos = (width - j[0]) / 2
+        elif h_align == "right":
+            h_pos = width - j[0]
+        ret.append((i, h_pos, int(cur_v_pos) - j[1] * offset
+                    + (int(k) - j[1] * (1 - offset)) / 2))
+        cur_v_pos += k
+    return (size, ret)
+
+
 def generate_vertitext(s_img: Image.Image,
                        item_list: list[str],
                        index: int,
                        para_list: dict[str,],
-                       meta_conf: dict[str,]) -> Tuple[Image.Image, int]:
+                       ctx: RenderContext) -> Tuple[Image.Image, int]:
     """Generating image of 'vertitext' type"""
     text = item_list[index]
-    text_len = len(text)
-    [tmp_font, tmp_size] = get_text_size(text[0], para_list["font"],
-                                         [para_list["width"], int(para_list["height"] /
-                                                                  text_len)],
-                                         para_list.get("offset", 0))
-    for i in text[1:]:
-        tmp_fontset = get_text_size(i, para_list["font"],
-                                    [para_list["width"], int(para_list["height"] /
-                                                             text_len)],
-                                    para_list.get("offset", 0))
-        if tmp_fontset[1] >= tmp_size:
-            [tmp_font, tmp_size] = tmp_fontset
-    text_size = [0, 0]
-    v_step = []
-    for i in text:
-        single_size = [tmp_font.getsize(i)[0],
-                       tmp_font.getsize(i)[1] * (1 - para_list.get("offset", 0))]
-        text_size[0] = max(text_size[0], single_size[0])
-        text_size[1] += single_size[1]
-        v_step.append(single_size[1])
-        if i != text[-1]:
-            text_size[1] += para_list["space"]
-            v_step[-1] += para_list["space"]
-    if para_list["vertical_align"] == "center":
-        cur_v_pos = int((para_list["height"] - text_size[1]) / 2)
-    elif para_list["vertical_align"] == "bottom":
-        cur_v_pos = para_list["height"] - text_size[1]
-    else:
-        cur_v_pos = 0
-    cur_v_pos += para_list["position"][1]
-    for i in range(text_len):
-        (new_img, _, _) = draw_text(s_img, text[i], para_list["font"], para_list["color"],
-                            [para_list["position"][0], int(cur_v_pos)],
-                            [para_list["width"], int(v_step[i])],
-                            para_list["horizontal_align"], "center",
-                            para_list.get("offset", 0))
-        cur_v_pos += v_step[i]
-    return (new_img, index + 1)
+    if text == "":
+        return (s_img, index + 1)
+    (x, y, width, height) = para_list["box"]
+    (size, glyphs) = layout_vertitext(
+        text, para_list["font"], width, height, para_list["space"],
+        para_list["offset"], para_list["horizontal_align"],
+        para_list["vertical_align"])
+    for (i, j, k) in glyphs:
+        paste_text(s_img, [x + j, y + k], i + "　", para_list["font"], size,
+                   para_list["color"])
+    return (s_img, index + 1)
 
 
 def generate_doubletext_nl(s_img: Image.Image,
                            item_list: list[str],
                            index: int,
                            para_list: dict[str,],
-                           meta_conf: dict[str,]) -> Tuple[Image.Image, int]:
+                           ctx: RenderContext) -> Tuple[Image.Image, int]:
     """Generating image of 'doubletext_nl' type"""
-    single_height = int((para_list["height"] - para_list["space"])/2)
-    (new_img, _, _) = draw_text(s_img, item_list[index],
-                        para_list["font"], para_list["color"], para_list["position"],
-                        [para_list["width"],
-                         single_height], para_list["horizontal_align"],
-                        para_list["vertical_align"], para_list.get("offset", 0))
-    (new_img, _, _) = draw_text(new_img, item_list[index + 1],
-                        para_list["font"], para_list["color"],
-                        [para_list["position"][0], para_list["position"]
-                         [1] + single_height + para_list["space"]],
-                        [para_list["width"],
-                         single_height], para_list["horizontal_align"],
-                        para_list["vertical_align"], para_list.get("offset", 0))
+    (upper, lower) = para_list["boxes"]
+    (new_img, _, _) = draw_text(s_img, ctx, item_list[index],
+                        para_list["font"], para_list["color"], upper[:2], upper[2:],
+                        para_list["anchor"], para_list["offset"])
+    (new_img, _, _) = draw_text(new_img, ctx, item_list[index + 1],
+                        para_list["font"], para_list["color"], lower[:2], lower[2:],
+                        para_list["anchor"], para_list["offset"])
     return (new_img, index + 2)
 
 
@@ -255,43 +712,31 @@ def generate_doubletext(s_img: Image.Image,
                         item_list: list[str],
                         index: int,
                         para_list: dict[str,],
-                        meta_conf: dict[str,]) -> Tuple[Image.Image, int]:
+                        ctx: RenderContext) -> Tuple[Image.Image, int]:
     """Generating image of 'doubletext' type"""
     if item_list[index + 1] == "":
-        return [generate_text(s_img, item_list, index, para_list)[0], index + 2]
-    i_size = [para_list["width"], para_list["height"]]
-    [major_font, major_size] = get_text_size(item_list[index], para_list["font"],
-                                             i_size, para_list.get("offset", 0))
-    major_text_size = major_font.getsize(item_list[index])
-    [minor_font, minor_size] = get_text_size(item_list[index + 1], para_list["font"],
-                                             [i_size[0] - major_text_size[0] - para_list["space"],
-                                              i_size[1]], para_list.get("offset", 0))
-    while minor_size < para_list["minimum_point"] or \
-            major_size - minor_size > para_list["maximum_diff"]:
-        major_size -= 1
-        major_font = ImageFont.truetype(para_list["font"], major_size)
-        major_text_size = major_font.getsize(item_list[index])
-        [minor_font, minor_size] = get_text_size(item_list[index + 1], para_list["font"],
-                                                 [i_size[0] - major_text_size[0] -
-                                                  para_list["space"], i_size[1]],
-                                                 para_list.get("offset", 0))
-    if major_size - minor_size <= para_list["minimum_diff"]:
-        minor_size = max(para_list["minimum_point"],
-                         major_size - para_list["minimum_diff"])
-    minor_font = major_font = ImageFont.truetype(para_list["font"], minor_size)
-    minor_text_size = minor_font.getsize(item_list[index + 1])
-    (new_img, _, _) = draw_text(s_img, item_list[index],
-                        para_list["font"], para_list["color"], para_list["position"],
-                        [major_text_size[0], para_list["height"]], "left",
-                        para_list["vertical_align"], para_list.get("offset", 0))
-    minor_pos = para_list["position"].copy()
-    minor_pos[0] += major_text_size[0] + para_list["space"]
-    minor_textsize = [minor_text_size[0], para_list["height"]].copy()
-    (new_img2, _, _) = draw_text(new_img, item_list[index + 1],
-                         para_list["font"], para_list["color"], minor_pos,
-                         minor_textsize, para_list["horizontal_align_right"],
-                         para_list["vertical_align"], para_list.get("offset", 0))
-    #print (major_size,", ",minor_size,", ",item_list[index])
+        return [generate_text(s_img, item_list, index, para_list, ctx)[0], index + 2]
+    font_loc = para_list["font"]
+    (major_size, minor_size) = fit_doubletext(
+        item_list[index], item_list[index + 1], font_loc,
+        para_list["width"], para_list["height"], para_list["space"],
+        para_list["minimum_point"], para_list["minimum_diff"], para_list["maximum_diff"])
+    major_text_size = get_text_extent(item_list[index], font_loc, major_size)
+    minor_text_size = get_text_extent(item_list[index + 1], font_loc, minor_size)
+    # a negative position is the right end of the left text, so it depends on the contents
+    major_pos = list(para_list["position"])
+    if (major_pos[0] < 0 and ctx.max_width != 0):
+        major_pos[0] = ctx.max_width + major_pos[0] - major_text_size[0]
+    (new_img, _, _) = draw_text(s_img, ctx, item_list[index],
+                        font_loc, para_list["color"], major_pos,
+                        [major_text_size[0], para_list["height"]],
+                        (0, para_list["anchor"][1]), para_list["offset"])
+    minor_pos = [major_pos[0] + major_text_size[0] + para_list["space"], major_pos[1]]
+    (new_img2, _, _) = draw_text(new_img, ctx, item_list[index + 1],
+                         font_loc, para_list["color"], minor_pos,
+                         [minor_text_size[0], para_list["height"]],
+                         (para_list["anchor_right"], para_list["anchor"][1]),
+                         para_list["offset"])
     return (new_img2, index + 2)
 
 
@@ -299,39 +744,23 @@ def generate_figure(s_img: Image.Image,
                     item_list: list[str],
                     index: int,
                     para_list: dict[str,],
-                    meta_conf: dict[str,]) -> Tuple[Image.Image, int]:
+                    ctx: RenderContext) -> Tuple[Image.Image, int]:
     """Generating image of 'figure' type"""
     try:
         if item_list[index] == "":
             return [s_img, index + 1]
     except KeyError:
         return [s_img, index + 1]
-    #print(para_list, ", ", item_list[index])
     new_img = s_img
-    try:
-        imgfile = find_file(item_list[index])
-    except NameError:
-        imgfile = meta_conf["figure_alias"][item_list[index]]
-    fig: Image.Image = Image.open(imgfile)
-    
-    if (para_list["position"][0] < 0 and max_width != 0):
-        para_list["position"][0] = max_width + para_list["position"][0] - para_list["width"]
-    
-    if para_list["keep_aspect_ratio"] == 0:
-        fig = fig.resize((para_list["width"], para_list["height"]))
-        pos = para_list["position"]
-    else:
-        fig.thumbnail((para_list["width"], para_list["height"]))
-        pos = para_list["position"].copy()
-        if para_list["horizontal_align"] == "center":
-            pos[0] += int((para_list["width"] - fig.size[0]) / 2)
-        elif para_list["horizontal_align"] == "right":
-            pos[0] += para_list["width"] - fig.size[0]
-        if para_list["vertical_align"] == "center":
-            pos[1] += int((para_list["height"] - fig.size[1]) / 2)
-        elif para_list["vertical_align"] == "bottom":
-            pos[1] += para_list["height"] - fig.size[1]
-    new_img.paste(fig, pos, fig.convert("RGBA"))
+    imgfile = find_figure(item_list[index], ctx)
+    (x, y, width, height) = para_list["box"]
+    (fig, fig_mask) = load_figure(imgfile, (width, height),
+                                  para_list["keep_aspect_ratio"])
+    pos = [x, y]
+    if para_list["keep_aspect_ratio"] != 0:
+        pos[0] += int((width - fig.size[0]) * para_list["anchor"][0])
+        pos[1] += int((height - fig.size[1]) * para_list["anchor"][1])
+    new_img.paste(fig, pos, fig_mask)
     return (new_img, index + 1)
 
 
@@ -345,157 +774,817 @@ def generate_text_plus_fig(s_img: Image.Image,
                   item_list: list[str],
                   index: int,
                   para_list: dict[str,],
-                  meta_conf: dict[str,]) -> Tuple[Image.Image, int]:
+                  ctx: RenderContext) -> Tuple[Image.Image, int]:
     """Generating image of 'text_plus_fig' type"""
     # This type will keep aspect ratio by default and this can't be changed
-    #print(index, ",", para_list["position"])
 
     # calculate and resize the image
     if len(item_list) <= index + 1 or item_list[index + 1] == "" or item_list[index + 1] == None:
         (ret_img, ret_index) = generate_text(
-            s_img, item_list, index, para_list, meta_conf)
+            s_img, item_list, index, para_list, ctx)
         return (ret_img, ret_index + 1)
     new_img = s_img
-    try:
-        imgfile = find_file(item_list[index + 1])
-    except NameError:
-        imgfile = meta_conf["figure_alias"][item_list[index + 1]]
-    fig: Image.Image = Image.open(imgfile)
+    imgfile = find_figure(item_list[index + 1], ctx)
+    (x, y, width, height) = para_list["box"]
+    (fig, fig_mask) = load_figure(imgfile, (width, height))
 
-    fig.thumbnail((para_list["width"], para_list["height"]))
-    fig_pos = para_list["position"].copy()
-    fig_pos[0] += para_list["width"] - fig.size[0] # right
-    fig_pos[1] += int((para_list["height"] - fig.size[1]) / 2) # middle
+    fig_pos = [x + width - fig.size[0], # right
+               y + int((height - fig.size[1]) / 2)] # middle
 
     # add the text
-    (new_img, new_pos, new_size) = draw_text(s_img, item_list[index],
-                        para_list["font"], para_list["color"],
-                        para_list["position"],
-                        [para_list["width"] - fig.size[0],
-                         para_list["height"]],
-                        para_list["horizontal_align"],
-                        para_list["vertical_align"], para_list.get("offset", 0))
+    (new_img, new_pos, new_size) = draw_text(s_img, ctx, item_list[index],
+                        para_list["font"], para_list["color"], [x, y],
+                        [width - fig.size[0], height],
+                        para_list["anchor"], para_list["offset"])
     
     # paste the image
     if (para_list["figure_follow"] == True):
         fig_pos[0] = new_pos[0] + new_size[0]
-    new_img.paste(fig, fig_pos, fig.convert("RGBA"))
+    new_img.paste(fig, fig_pos, fig_mask)
 
     return (new_img, index + 2)
 
 
-def process_section(style: dict[str,],
+H_ANCHORS = {"center": 0.5, "right": 1}
+V_ANCHORS = {"center": 0.5, "bottom": 1}
+
+
+def compile_item(item_type: str, conf: dict[str,], ctx: RenderContext) -> dict[str,]:
+    """Resolving the box, anchors and color of an item, which are the same in every row
+
+    A negative x position is measured from max_width to the right end of the
+    box. doubletext resolves it per row instead, since its width depends on
+    the cells.
+    """
+    ret = dict(conf)
+    (x, y) = conf["position"]
+    ret["position"] = (x, y)
+    if item_type == "vertitext":
+        (x, y) = (int(x), int(y))
+    if (x < 0 and ctx.max_width != 0):
+        x = ctx.max_width + x - conf["width"]
+    ret["box"] = (x, y, conf["width"], conf["height"])
+    ret["anchor"] = (H_ANCHORS.get(conf.get("horizontal_align"), 0),
+                     V_ANCHORS.get(conf.get("vertical_align"), 0))
+    ret["color"] = conf.get("color") or ctx.default_color
+    ret["offset"] = conf.get("offset", 0)
+    if item_type == "doubletext":
+        ret["anchor_right"] = H_ANCHORS.get(conf.get("horizontal_align_right"), 0)
+    elif item_type == "doubletext_nl":
+        single_height = int((conf["height"] - conf["space"])/2)
+        ret["boxes"] = ((x, y, conf["width"], single_height),
+                        (x, y + single_height + conf["space"], conf["width"], single_height))
+    return ret
+
+
+ITEM_RENDERERS = {
+    "text": generate_text,
+    "colortext": generate_colortext,
+    "vertitext": generate_vertitext,
+    "doubletext_nl": generate_doubletext_nl,
+    "doubletext": generate_doubletext,
+    "figure": generate_figure,
+    #"figuregroup": generate_figuregroup
+    "text_plus_fig": generate_text_plus_fig
+}
+# the number of cells each item type takes, and which of them names a figure
+ITEM_CELLS = {"text": 1, "colortext": 2, "vertitext": 1, "doubletext_nl": 2,
+              "doubletext": 2, "figure": 1, "text_plus_fig": 2}
+FIGURE_CELLS = {"figure": 0, "text_plus_fig": 1}
+
+
+@dataclass
+class CompiledItem:
+    """Item with its defaults merged, its static geometry resolved and its renderer bound
+
+    The renderer gets draw, which is never modified, as its parameters.
+    """
+    type: str
+    conf: dict[str,]
+    draw: dict[str,] = field(repr=False, compare=False)
+    render: Callable = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.render is None:
+            self.render = ITEM_RENDERERS[self.type]
+
+    # the renderer is bound again after unpickling instead of being pickled
+    def __getstate__(self):
+        return (self.type, self.conf, self.draw)
+
+    def __setstate__(self, state):
+        (self.type, self.conf, self.draw) = state
+        self.render = ITEM_RENDERERS[self.type]
+
+
+@dataclass
+class CompiledLayout:
+    """Partial layout with its background resolved, and its items as a draw list"""
+    background: str
+    items: list[CompiledItem]
+
+    def get_figure_cells(self) -> list[int]:
+        """Getting the indices of cells naming figures in a row"""
+        ret = []
+        index = 0
+        for i in self.items:
+            if i.type in FIGURE_CELLS:
+                ret.append(index + FIGURE_CELLS[i.type])
+            index += ITEM_CELLS[i.type]
+        return ret
+
+
+@dataclass
+class CompiledStyle:
+    """Style checked and prepared for rendering rows"""
+    name: str
+    ctx: RenderContext
+    layouts: dict[str, CompiledLayout]
+    key: tuple = ()
+    digests: dict[str, str] = field(default_factory=dict, repr=False, compare=False)
+
+    def layout_digest(self, layout_type: str) -> str:
+        """Getting the hash of everything in the style affecting the layout"""
+        if layout_type not in self.digests:
+            layout = self.layouts[layout_type]
+            state = [asdict(self.ctx), layout.background,
+                     [(i.type, i.conf) for i in layout.items]]
+            import hashlib
+            self.digests[layout_type] = hashlib.sha256(json.dumps(
+                state, sort_keys=True, default=str).encode()).hexdigest()
+        return self.digests[layout_type]
+
+    def to_state(self) -> dict[str,]:
+        """Converting to plain data, which is kept in the on-disk cache"""
+        return {"name": self.name, "key": self.key, "ctx": asdict(self.ctx),
+                "layouts": {i: (j.background, [(k.type, k.conf, k.draw) for k in j.items])
+                            for (i, j) in self.layouts.items()}}
+
+    @classmethod
+    def from_state(cls, state: dict[str,]):
+        """Restoring from plain data"""
+        return cls(state["name"], RenderContext(**state["ctx"]),
+                   {i: CompiledLayout(j[0], [CompiledItem(*k) for k in j[1]])
+                    for (i, j) in state["layouts"].items()},
+                   tuple(state["key"]))
+
+
+def compile_style(style_name: str, config_dir="config",
+                  input_dir="") -> CompiledStyle:
+    """Compiling the style, so that errors are reported before rendering"""
+    style_filename = os.path.abspath(find_style_file(style_name, config_dir))
+    style = get_style(style_name, config_dir)
+    ctx = RenderContext.from_style(style, os.path.dirname(style_filename),
+                                   os.path.abspath(input_dir))
+    ctx.meta = dict(ctx.meta)
+    if "figure_alias" in ctx.meta:
+        ctx.meta["figure_alias"] = dict(ctx.meta["figure_alias"])
+        for (i, j) in ctx.meta["figure_alias"].items():
+            ctx.meta["figure_alias"][i] = os.path.join(ctx.style_dir, j)
+            if not os.path.exists(ctx.meta["figure_alias"][i]):
+                raise NameError("{}: figure of alias \"{}\" not found".format(
+                    style_name, i))
+    try:
+        ImageColor.getrgb(ctx.default_color)
+    except ValueError:
+        raise NameError("{}: invalid default color \"{}\"".format(
+            style_name, ctx.default_color))
+    if ctx.compress_text_quality not in COMPRESS_TEXT_QUALITIES:
+        raise NameError("{}: invalid compress_text_quality \"{}\"".format(
+            style_name, ctx.compress_text_quality))
+    if "output" in ctx.meta:
+        try:
+            get_output_options(ctx.meta["output"])
+        except NameError as e:
+            raise NameError("{}: {}".format(style_name, e))
+
+    layouts = {}
+    for (layout_type, layout) in style.items():
+        if layout_type.startswith("_") or not isinstance(layout, dict) \
+                or "item" not in layout:
+            continue
+        err_prefix = "{}: [{}]".format(style_name, layout_type)
+        try:
+            background = find_file(layout["background"], ctx)
+        except (KeyError, NameError):
+            raise NameError(err_prefix + " background not found")
+        items = []
+        for i in layout["item"]:
+            if i.get("type") not in ITEM_RENDERERS:
+                raise NameError(err_prefix + " invalid item type \"{}\"".format(
+                    i.get("type")))
+            i_conf = layout.get("default_" + i["type"], {}).copy()
+            i_conf.update(i)
+            if "font" in i_conf:
+                i_conf["font"] = find_font(i_conf["font"], ctx)
+                try:
+                    load_font(i_conf["font"], 1)
+                except OSError:
+                    raise NameError(err_prefix + " font \"{}\" not found".format(
+                        i_conf["font"]))
+            if i_conf.get("color"):
+                try:
+                    ImageColor.getrgb(i_conf["color"])
+                except ValueError:
+                    raise NameError(err_prefix + " invalid color \"{}\"".format(
+                        i_conf["color"]))
+            try:
+                draw = compile_item(i["type"], i_conf, ctx)
+            except KeyError as e:
+                raise NameError(err_prefix + " {} item without \"{}\"".format(
+                    i["type"], e.args[0]))
+            items.append(CompiledItem(i["type"], i_conf, draw))
+        layouts[layout_type] = CompiledLayout(background, items)
+    return CompiledStyle(style_name, ctx, layouts)
+
+
+def load_style(style_name: str, config_dir="config", input_dir="",
+               disk_cache=False) -> CompiledStyle:
+    """Getting the compiled style, cached by the path and mtime of layout file"""
+    style_filename = os.path.abspath(find_style_file(style_name, config_dir))
+    key = (STYLE_CACHE_VERSION, style_filename, os.path.getmtime(style_filename),
+           os.path.abspath(input_dir))
+    if key in _style_cache:
+        profile_count("style_cache_hit")
+        return _style_cache[key]
+    profile_count("style_cache_miss")
+    ret = None
+    if disk_cache:
+        import pickle
+        try:
+            with open(style_filename + ".pickle", "rb") as f:
+                ret = CompiledStyle.from_state(pickle.load(f))
+            if ret.key != key:
+                ret = None
+        except Exception: # a missing or broken cache is simply rebuilt
+            ret = None
+    if ret is None:
+        with profile_span("compile_style", style=style_name):
+            ret = compile_style(style_name, config_dir, input_dir)
+        ret.key = key
+        if disk_cache:
+            try:
+                with open(style_filename + ".pickle", "wb") as f:
+                    pickle.dump(ret.to_state(), f)
+            except OSError:
+                pass
+    _style_cache[key] = ret
+    return ret
+
+
+class TileCache:
+    """On-disk cache of rendered sections for incremental rendering
+
+    A tile is keyed by the hash of the style, layout type, cells of the row
+    and the mtimes of files it uses. Workers of parallel rendering may share
+    the directory, since tiles are written atomically.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.layout_assets = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_mtime(filename: str) -> float:
+        """Getting the mtime of the file, or 0 if it is not a file"""
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return 0
+
+    def get_key(self, style: CompiledStyle, layout_type: str,
+                item_list: list) -> str:
+        """Getting the key of the tile"""
+        layout_key = (style.name, style.layout_digest(layout_type))
+        if layout_key not in self.layout_assets:
+            layout = style.layouts[layout_type]
+            self.layout_assets[layout_key] = [self.get_mtime(layout.background)] + \
+                [self.get_mtime(i.conf["font"]) for i in layout.items if "font" in i.conf]
+        # only cells of figures are looked up, other cells may be any text
+        cell_assets = []
+        for i in style.layouts[layout_type].get_figure_cells():
+            if i < len(item_list) and isinstance(item_list[i], str) and item_list[i] != "":
+                try:
+                    cell_assets.append(self.get_mtime(find_figure(item_list[i], style.ctx)))
+                except (KeyError, NameError):
+                    cell_assets.append(0)
+        state = [TILE_CACHE_VERSION, layout_key, layout_type, item_list,
+                 self.layout_assets[layout_key], cell_assets]
+        import hashlib
+        return hashlib.sha256(json.dumps(state, default=str).encode()).hexdigest()
+
+    def get_filename(self, key: str) -> str:
+        """Getting the filename of the tile"""
+        return os.path.join(self.cache_dir, key[:2], key + ".png")
+
+    def get(self, key: str) -> Image.Image:
+        """Loading the tile, or None if it is not cached"""
+        try:
+            s_img = Image.open(self.get_filename(key))
+            s_img.load()
+        except OSError:
+            return None
+        return s_img
+
+    def put(self, key: str, s_img: Image.Image):
+        """Saving the tile"""
+        tmp_name = self.get_filename(key)
+        os.makedirs(os.path.dirname(tmp_name), exist_ok=True)
+        tmp_part = "{}.{}-{}.part".format(tmp_name, os.getpid(), threading.get_ident())
+        try:
+            s_img.save(tmp_part, format="png", compress_level=1,
+                       icc_profile=s_img.info.get("icc_profile"))
+            os.replace(tmp_part, tmp_name)
+        except (OSError, ValueError): # some modes can't be saved as PNG
+            if os.path.exists(tmp_part):
+                os.remove(tmp_part)
+
+
+def process_section(style: CompiledStyle,
                     layout_type: str,
                     item_list: list[str]) -> Image.Image:
     """Processing a single section"""
-    switchfunc = {
-        "text": generate_text,
-        "colortext": generate_colortext,
-        "vertitext": generate_vertitext,
-        "doubletext_nl": generate_doubletext_nl,
-        "doubletext": generate_doubletext,
-        "figure": generate_figure,
-        #"figuregroup": generate_figuregroup
-        "text_plus_fig": generate_text_plus_fig
-    }
     if layout_type.startswith('_'):
         raise NameError("Invalid type name")
-    layout = style[layout_type]
-    s_img = Image.open(find_file(layout["background"]))
+    layout = style.layouts[layout_type]
+    s_img = load_background(layout.background, style.ctx)
     index = 0
-    for i in layout["item"]:
-        try:
-            i_conf = layout["default_" + i["type"]].copy()
-            i_conf.update(i)
-        except KeyError:
-            i_conf = i.copy()
-        [s_img, index] = switchfunc[i["type"]](
-            s_img, item_list, index, i_conf, style["_meta"])
+    for i in layout.items:
+        with profile_span(i.render.__name__, "item", layout=layout_type) as span:
+            [s_img, new_index] = i.render(
+                s_img, item_list, index, i.draw, style.ctx)
+            if span is not None:
+                span.args["cells"] = item_list[index:new_index]
+        index = new_index
     return s_img
 
 
-def process_sheet(s_sheet: list[list]):
-    """Processing a single sheet"""
-    s_index = 0
-    s_len = len(s_sheet)
-    if (len(s_sheet[s_index]) == 0):
-        return
-    while s_sheet[s_index][0] == "//":
-        s_index += 1
-        if s_index == s_len:
-            raise NameError("No valid style")
-    style_name = s_sheet[s_index][0]
-    style = get_style(style_name)
-
-    # loading meta configs
-    global max_width
-    global default_color
-    global allow_compress_text
-    global compress_text_ratio
-    max_width = 0
-    default_color = "black"
-    allow_compress_text = False
-    compress_text_ratio = 1
-    if ("_meta" in style):
-        if ("max_width" in style["_meta"]):
-            max_width = style["_meta"]["max_width"]
-        if ("default_color" in style["_meta"]):
-            default_color = style["_meta"]["default_color"]
-        if ("allow_compress_text" in style["_meta"] and "compress_text_ratio" in style["_meta"]):
-            allow_compress_text = style["_meta"]["allow_compress_text"]
-            compress_text_ratio = style["_meta"]["compress_text_ratio"]
-            if ((not allow_compress_text)
-                or (type(compress_text_ratio) != int and type(compress_text_ratio) != float)
-                or compress_text_ratio > 1
-                or compress_text_ratio < 0):
-                compress_text_ratio = 1
-    
-    os.chdir(os.path.join("config", style_name))
-    s_index += 1
+def stitch_sections(sections: list[Image.Image]) -> Image.Image:
+    """Joining the sections vertically into one image"""
+    if not sections:
+        return None
+    # the canvas takes mode, palette and info of the first section, and the
+    # uncovered area on the right of narrower sections is left as zero
+    first_img = sections[0]
+    with profile_span("stitch", sections=len(sections)):
+        main_img = Image.new(first_img.mode,
+                             (max(i.size[0] for i in sections),
+                              sum(i.size[1] for i in sections)))
+        if first_img.mode in ("P", "PA"):
+            main_img.putpalette(first_img.getpalette())
+        main_img.info.update(first_img.info)
+        cur_height = 0
+        for i in sections:
+            main_img.paste(i, (0, cur_height))
+            cur_height += i.size[1]
+    return main_img
+
+
+def iter_pages(sections: Iterable[Image.Image],
+               max_height: int) -> Iterator[Image.Image]:
+    """Joining the sections into pages no higher than max_height
+
+    Pages are only split between sections, so a section higher than
+    max_height takes a page of its own. Only one page is kept in memory.
+    """
+    page = []
+    page_height = 0
+    for i in sections:
+        if page and page_height + i.size[1] > max_height:
+            yield stitch_sections(page)
+            page = []
+            page_height = 0
+        page.append(i)
+        page_height += i.size[1]
+    if page:
+        yield stitch_sections(page)
+
+
+def process_section_cached(style: CompiledStyle, layout_type: str,
+                           item_list: list[str], tile_cache: TileCache = None) -> Image.Image:
+    """Processing a single section, reusing the tile rendered before if any"""
+    if tile_cache is None:
+        return process_section(style, layout_type, item_list)
+    key = tile_cache.get_key(style, layout_type, item_list)
+    s_img = tile_cache.get(key)
+    if s_img is None:
+        profile_count("tile_cache_miss")
+        s_img = process_section(style, layout_type, item_list)
+        with profile_span("save_tile"):
+            tile_cache.put(key, s_img)
+    else:
+        profile_count("tile_cache_hit")
+    return s_img
+
+
+_worker_style = None
+_worker_tile_cache = None
+
+
+def _get_mp_context():
+    """Getting the context of process pools, which never forks this process
+
+    Images may be saved by other threads while a pool is started, and a forked
+    worker would inherit the locks they hold, such as the import lock.
+    """
+    import multiprocessing
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _init_section_worker(style: CompiledStyle, tile_cache: TileCache):
+    """Initializing a worker process of parallel rendering"""
+    global _worker_style
+    global _worker_tile_cache
+    _worker_style = style
+    _worker_tile_cache = tile_cache
+
+
+def _process_sections_job(rows: list[Tuple[str, list[str]]]) -> list[Image.Image]:
+    """Processing a chunk of sections in a worker process"""
+    return [process_section_cached(_worker_style, i[0], i[1], _worker_tile_cache)
+            for i in rows]
+
+
+def _iter_chunks(iterable: Iterable, chunk_size: int) -> Iterator[list]:
+    """Splitting the items into lists of chunk_size"""
+    chunk = []
+    for i in iterable:
+        chunk.append(i)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_profiled(iterable: Iterable, name: str) -> Iterator:
+    """Timing the reading of each item as a stage"""
+    iterator = iter(iterable)
+    end = object()
+    while True:
+        with profile_span(name):
+            i = next(iterator, end)
+        if i is end:
+            return
+        yield i
+
+
+def _iter_sheet_rows(s_rows: Iterator[list]) -> Iterator[Tuple[str, list]]:
+    """Getting (layout type, cells) of rows after the style row"""
     current_type = "default"
-    main_img = None
-    main_size = [0, 0]
-    for i in s_sheet[s_index:]:
+    for i in s_rows:
         if i[0] == "//":
             continue
         if i[0] != "":
             current_type = i[0]
-        s_img = process_section(
-            style, current_type, i[1:])
-        s_size = list(s_img.size)
-        if main_img is None:
-            main_img = s_img
-            main_size = s_size
-        else:
-            new_size = [max(main_size[0], s_size[0]), main_size[1] + s_size[1]]
-            main_img = main_img.crop([0, 0] + new_size)
-            new_box = [0, main_size[1], s_size[0], new_size[1]]
-            main_img.paste(s_img, new_box)
-            main_size = new_size
-    os.chdir(os.path.dirname(os.path.dirname(os.getcwd())))
-    return main_img
+        yield (current_type, i[1:])
+
+
+def parse_sheet(s_sheet: Iterable[list]) -> Tuple[str, Iterator[Tuple[str, list]]]:
+    """Getting the style name and (layout type, cells) of each row of a sheet
+
+    The rows are read lazily, so the sheet can be a stream of rows.
+    """
+    s_rows = iter(s_sheet)
+    s_row = next(s_rows, [])
+    if (len(s_row) == 0):
+        return (None, iter(()))
+    while s_row[0] == "//":
+        s_row = next(s_rows, None)
+        if s_row is None:
+            raise NameError("No valid style")
+    return (s_row[0], _iter_sheet_rows(s_rows))
+
+
+def get_output_options(*options: dict[str,]) -> dict[str,]:
+    """Merging output options, the later ones take precedence
+
+    Valid options are "format" (png, webp or jpeg), "compress_level" for PNG,
+    "quality" and "lossless" for WebP and JPEG, and "colors" for reducing
+    the image to a palette. Options set to None are ignored.
+    """
+    ret = {"format": "png"}
+    for i in options:
+        ret.update({j: k for (j, k) in i.items() if k is not None})
+    ret["format"] = ret["format"].lower().replace("jpg", "jpeg")
+    if ret["format"] not in OUTPUT_FORMATS:
+        raise NameError("Unsupported output format \"{}\"".format(ret["format"]))
+    return ret
+
+
+def prepare_output(img: Image.Image,
+                   options: dict[str,]) -> Tuple[Image.Image, str, dict[str,]]:
+    """Getting the image, format and parameters for saving"""
+    params = {}
+    if options.get("colors") and options["format"] != "jpeg":
+        if img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA")
+        img = img.quantize(options["colors"])
+    if options["format"] == "png":
+        if "compress_level" in options:
+            params["compress_level"] = options["compress_level"]
+    elif options["format"] == "webp":
+        params["lossless"] = options.get("lossless", False)
+        if "quality" in options:
+            params["quality"] = options["quality"]
+    else:
+        # JPEG has no alpha channel, so it only suits opaque layouts
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        if "quality" in options:
+            params["quality"] = options["quality"]
+    return (img, options["format"], params)
+
+
+def save_image(img: Image.Image, fp, options: dict[str,]):
+    """Saving the image to a filename or file object with output options"""
+    with profile_span("encode", format=options["format"]):
+        (img, format, params) = prepare_output(img, options)
+        img.save(fp, format=format, **params)
+
+
+class ImageWriter:
+    """Saving images in background threads while the next ones are rendered"""
+
+    def __init__(self, workers=1):
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(workers)
+        self.pending = deque()
+        # images waiting for encoding hold memory, so only a few are queued
+        self.max_pending = workers * 2
+
+    def collect(self, max_pending: int) -> list[str]:
+        """Waiting for saved images, returning their filenames"""
+        ret = []
+        while self.pending and (len(self.pending) > max_pending
+                                or self.pending[0][0].done()):
+            (future, filename) = self.pending.popleft()
+            future.result()
+            ret.append(filename)
+        return ret
+
+    def save(self, img: Image.Image, filename: str,
+             options: dict[str,]) -> list[str]:
+        """Queueing the image, returning filenames of images saved meanwhile"""
+        # the threads report to the hooks active here
+        self.pending.append((self.pool.submit(contextvars.copy_context().run,
+                                              save_image, img, filename, options),
+                             filename))
+        return self.collect(self.max_pending)
+
+    def close(self) -> list[str]:
+        """Waiting for all images, returning their filenames"""
+        ret = self.collect(0)
+        self.pool.shutdown()
+        return ret
+
+
+class Renderer:
+    """Rendering sheets with explicit directories
+
+    The renderer never changes the working directory or any global state, so
+    one instance can be shared by multiple threads.
+    """
+
+    def __init__(self, config_dir="config", input_dir="", jobs=1,
+                 style_cache=False, tile_cache_dir=None):
+        self.config_dir = os.path.abspath(config_dir)
+        self.input_dir = os.path.abspath(input_dir)
+        self.jobs = jobs
+        self.style_cache = style_cache
+        self.tile_cache = None if tile_cache_dir is None else TileCache(tile_cache_dir)
+
+    def load_style(self, style_name: str) -> CompiledStyle:
+        """Getting the compiled style"""
+        return load_style(style_name, self.config_dir, self.input_dir,
+                          self.style_cache)
+
+    def render_section(self, style_name: str, layout_type: str,
+                       item_list: list[str]) -> Image.Image:
+        """Rendering a single row"""
+        return process_section_cached(self.load_style(style_name), layout_type,
+                                      item_list, self.tile_cache)
+
+    def iter_sections(self, style_name: str,
+                      rows: Iterable[Tuple[str, list]]) -> Iterator[Image.Image]:
+        """Rendering (layout type, cells) rows one by one, in the order of rows
+
+        Identical rows are rendered once and share the same image, so the
+        images should not be modified.
+        """
+        style = self.load_style(style_name)
+        sections = ImageCache(SECTION_CACHE_BYTES, "section")
+        if _instrument.get() is not None:
+            rows = _iter_profiled(rows, "read")
+        if self.jobs <= 1:
+            for (j, i) in enumerate(rows, 1):
+                key = (i[0], tuple(i[1]))
+                s_img = sections.get(key)
+                if s_img is not None:
+                    profile_count("deduplicated_rows")
+                    yield s_img
+                    continue
+                with profile_span("row", "row", section=j, layout=i[0], cells=i[1]):
+                    s_img = process_section_cached(style, i[0], i[1], self.tile_cache)
+                sections.put(key, s_img, s_img)
+                yield s_img
+            return
+        # only a few chunks are submitted ahead, so rows are still read lazily
+        from concurrent.futures import ProcessPoolExecutor
+        submitted = set()
+
+        def finish(keys, hits, misses, future):
+            if future is not None:
+                for (i, j) in zip(misses, future.result()):
+                    hits[i] = j
+                    sections.put(i, j, j)
+                    submitted.discard(i)
+            for (i, j) in hits.items():
+                if j is None:
+                    # rendered in an earlier chunk, unless it is no longer cached
+                    j = sections.get(i)
+                    if j is None:
+                        j = process_section_cached(style, i[0], list(i[1]), self.tile_cache)
+                    hits[i] = j
+            profile_count("deduplicated_rows", len(keys) - len(misses))
+            return [hits[i] for i in keys]
+
+        with ProcessPoolExecutor(self.jobs, _get_mp_context(),
+                                 initializer=_init_section_worker,
+                                 initargs=(style, self.tile_cache)) as pool:
+            pending = deque()
+            for i in _iter_chunks(rows, SECTION_CHUNK_SIZE):
+                # only rows not rendered or submitted yet are sent, each of them once
+                keys = [(j[0], tuple(j[1])) for j in i]
+                hits = {}
+                for j in keys:
+                    if j not in hits:
+                        hits[j] = None if j in submitted else sections.get(j)
+                misses = [j for (j, k) in hits.items() if k is None and j not in submitted]
+                submitted.update(misses)
+                future = None
+                if misses:
+                    future = pool.submit(_process_sections_job,
+                                         [(j[0], list(j[1])) for j in misses])
+                pending.append((keys, hits, misses, future))
+                if len(pending) > self.jobs * 2:
+                    yield from finish(*pending.popleft())
+            while pending:
+                yield from finish(*pending.popleft())
+
+    def render_rows(self, style_name: str,
+                    rows: Iterable[Tuple[str, list]]) -> Image.Image:
+        """Rendering (layout type, cells) rows, joined vertically"""
+        return stitch_sections(list(self.iter_sections(style_name, rows)))
+
+    def render_sheet(self, s_sheet: Iterable[list]) -> Image.Image:
+        """Rendering a sheet whose first valid row names the style"""
+        (style_name, rows) = parse_sheet(s_sheet)
+        if style_name is None:
+            return None
+        return self.render_rows(style_name, rows)
+
+    def render_sheet_output(self, s_sheet: Iterable[list], page_height=0,
+                            output_options=None) -> Tuple[dict[str,], Iterator[Image.Image]]:
+        """Rendering a sheet into its images, with output options of its style
+
+        The images are the pages of the sheet if page_height is given, and there
+        is none for a sheet without rows. The output options given take
+        precedence over those in the style.
+        """
+        (style_name, rows) = parse_sheet(s_sheet)
+        if style_name is None:
+            return (get_output_options(output_options or {}), iter(()))
+        options = self.get_output_options(style_name, output_options)
+        if page_height:
+            return (options, iter_pages(self.iter_sections(style_name, rows), page_height))
+        img = self.render_rows(style_name, rows)
+        return (options, iter(() if img is None else (img,)))
+
+    def render_sheet_bytes(self, s_sheet: Iterable[list], format=None,
+                           **output_options) -> bytes:
+        """Rendering a sheet into encoded image data, as render_sheet_buffer"""
+        return bytes(self.render_sheet_buffer(s_sheet, dict(output_options, format=format)))
+
+    def get_output_options(self, style_name: str, output_options=None) -> dict[str,]:
+        """Getting the output options of the style, overridden by those given"""
+        return get_output_options(self.load_style(style_name).ctx.meta.get("output", {}),
+                                  output_options or {})
+
+    def save_sheet(self, s_sheet: Iterable[list], fp,
+                   output_options=None) -> dict[str,]:
+        """Rendering a sheet into a filename or file object, returning the output options
+
+        Nothing is written to the file system other than fp.
+        """
+        (options, images) = self.render_sheet_output(s_sheet, 0, output_options)
+        img = next(images, None)
+        if img is None:
+            raise NameError("Empty sheet")
+        save_image(img, fp, options)
+        return options
+
+    def save_section(self, style_name: str, layout_type: str, item_list: list[str],
+                     fp, output_options=None) -> dict[str,]:
+        """Rendering a single row into a filename or file object, returning the output options"""
+        options = self.get_output_options(style_name, output_options)
+        save_image(self.render_section(style_name, layout_type, item_list), fp, options)
+        return options
+
+    def render_sheet_buffer(self, s_sheet: Iterable[list],
+                            output_options=None) -> memoryview:
+        """Rendering a sheet into encoded image data with the output options of its style"""
+        buffer = io.BytesIO()
+        self.save_sheet(s_sheet, buffer, output_options)
+        return buffer.getbuffer()
+
+    def render_section_buffer(self, style_name: str, layout_type: str,
+                              item_list: list[str], output_options=None) -> memoryview:
+        """Rendering a single row into encoded image data with the output options of its style"""
+        buffer = io.BytesIO()
+        self.save_section(style_name, layout_type, item_list, buffer, output_options)
+        return buffer.getbuffer()
+
+
+def process_sheet(s_sheet: Iterable[list], config_dir="config", input_dir="",
+                  jobs=1, style_cache=False, tile_cache_dir=None):
+    """Processing a single sheet"""
+    return Renderer(config_dir, input_dir, jobs, style_cache,
+                    tile_cache_dir).render_sheet(s_sheet)
+
+
+def iter_csv_file(csv_filename: str) -> Iterator[Tuple[str, Iterator[list]]]:
+    """Reading CSV file lazily"""
+    import csv
+    with open(csv_filename, "r") as c_file:
+        yield ("csvsheet", csv.reader(c_file))
+
+
+def iter_xls_file(excel_filename: str) -> Iterator[Tuple[str, Iterator[list]]]:
+    """Reading .xls file lazily, loading one sheet at a time"""
+    import xlrd
+    x_book = xlrd.open_workbook(excel_filename, on_demand=True)
+    try:
+        for i in range(x_book.nsheets):
+            tmp_sheet = x_book.sheet_by_index(i)
+            yield (tmp_sheet.name,
+                   (tmp_sheet.row_values(j) for j in range(tmp_sheet.nrows)))
+            x_book.unload_sheet(i)
+    finally:
+        x_book.release_resources()
+
+
+def iter_xlsx_file(excel_filename: str) -> Iterator[Tuple[str, Iterator[list]]]:
+    """Reading .xlsx file lazily with the read-only mode of openpyxl"""
+    try:
+        import openpyxl
+    except ImportError:
+        # xlrd before 2.0 can still read .xlsx files
+        yield from iter_xls_file(excel_filename)
+        return
+    x_book = openpyxl.load_workbook(excel_filename, read_only=True, data_only=True)
+    try:
+        for tmp_sheet in x_book.worksheets:
+            yield (tmp_sheet.title,
+                   (["" if j is None else j for j in i]
+                    for i in tmp_sheet.iter_rows(values_only=True)))
+    finally:
+        x_book.close()
+
+
+def iter_sheets(filename: str) -> Iterator[Tuple[str, Iterator[list]]]:
+    """Reading (name, rows) of each sheet lazily
+
+    The rows of a sheet should be consumed before getting the next sheet.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".csv":
+        return iter_csv_file(filename)
+    elif ext == ".xlsx":
+        return iter_xlsx_file(filename)
+    elif ext == ".xls":
+        return iter_xls_file(filename)
+    raise NameError("Unsupported file type")
 
 
 def read_csv_file(csv_filename: str) -> dict[str, list[list]]:
     """Reading CSV file"""
-    c_file = open(csv_filename, "r")
-    content = list(csv.reader(c_file))
-    c_file.close()
-    return {"csvsheet": content}
+    return {i: list(j) for (i, j) in iter_csv_file(csv_filename)}
 
 
 def read_excel_file(excel_filename: str) -> dict[str, list[list]]:
     """Reading .xlsx/.xls file"""
-    x_book = xlrd.open_workbook(excel_filename)
-    content = {}
-    tmp_sheetname = x_book.sheet_names()
-    for i in range(x_book.nsheets):
-        tmp_content = []
-        tmp_sheet = x_book.sheet_by_index(i)
-        for j in range(tmp_sheet.nrows):
-            tmp_content += [tmp_sheet.row_values(j)]
-        content[tmp_sheetname[i]] = tmp_content
-    return content
+    if excel_filename.lower().endswith(".xlsx"):
+        return {i: list(j) for (i, j) in iter_xlsx_file(excel_filename)}
+    return {i: list(j) for (i, j) in iter_xls_file(excel_filename)}
+
+
+def read_sheets(filename: str) -> dict[str, list[list]]:
+    """Reading all sheets of the spreadsheet file"""
+    return {i: list(j) for (i, j) in iter_sheets(filename)}
 
 
 def valid_filename(input_filename: str) -> str:
@@ -503,53 +1592,498 @@ def valid_filename(input_filename: str) -> str:
     return input_filename.translate(str.maketrans("*/\\<>:\"|", "--------"))
 
 
+def get_output_name(input_filename: str, sheet_name: str, output_dir: str,
+                    reserved=(), ext=".png", overwrite=False) -> str:
+    """Getting an unused name of the output image, existing files are used if overwrite"""
+    tmp_name = os.path.join(
+        output_dir, valid_filename(
+            os.path.basename(input_filename)).
+        rsplit(".", 1)[0] + "_" + valid_filename(sheet_name))
+    if (os.path.exists(tmp_name + ext) and not overwrite) or tmp_name + ext in reserved:
+        for j in range(1, 100):
+            if (not os.path.exists(tmp_name + "-" + str(j) + ext) or overwrite) and \
+                    tmp_name + "-" + str(j) + ext not in reserved:
+                return tmp_name + "-" + str(j) + ext
+        raise NameError("Too many duplicated file names")
+    return tmp_name + ext
+
+
+def write_file_output(input_filename: str, output: str, renderer: Renderer,
+                      output_options: dict[str,]) -> bool:
+    """Rendering the first non-empty sheet into a file, or stdout if output is "-"
+
+    Returning whether there is a sheet to render. The other sheets having
+    contents are not rendered, and they are listed on stderr.
+    """
+    sheets = iter_sheets(input_filename)
+    for (_, rows) in sheets:
+        (options, images) = renderer.render_sheet_output(rows, 0, output_options)
+        img = next(images, None)
+        if img is None:
+            continue
+        if output == "-":
+            save_image(img, sys.stdout.buffer, options)
+            sys.stdout.buffer.flush()
+        else:
+            save_image(img, output, options)
+        skipped = []
+        for (i, j) in sheets:
+            try:
+                if parse_sheet(j)[0] is not None:
+                    skipped.append(i)
+            except NameError: # sheets of comments only
+                pass
+        if skipped:
+            print("WARNING", "only the first sheet is written, skipped:",
+                  ", ".join(skipped), file=sys.stderr)
+        return True
+    return False
+
+
+def find_input_files(paths: list[str]) -> list[str]:
+    """Finding spreadsheet files from files, directories and glob patterns"""
+    ret = []
+    for i in paths:
+        if os.path.isdir(i):
+            tmp_files = [os.path.join(i, j) for j in sorted(os.listdir(i))]
+        elif os.path.exists(i):
+            ret.append(i)
+            continue
+        else:
+            import glob
+            tmp_files = sorted(glob.glob(i, recursive=True))
+        ret += [j for j in tmp_files
+                if os.path.isfile(j) and j.lower().endswith(SPREADSHEET_EXTENSIONS)]
+    # the same file may be matched by more than one pattern
+    return list({os.path.abspath(i): i for i in ret}.values())
+
+
+def get_sheet_ext(renderer: Renderer, s_sheet: Iterable[list],
+                  output_options: dict[str,]) -> str:
+    """Getting the extension of the output of a sheet, with the format of its style if possible"""
+    try:
+        style_name = parse_sheet(s_sheet)[0]
+        if style_name is not None:
+            return OUTPUT_FORMATS[renderer.get_output_options(style_name,
+                                                              output_options)["format"]]
+    except Exception: # the sheet fails again when it is rendered, and is reported then
+        pass
+    return OUTPUT_FORMATS[get_output_options(output_options)["format"]]
+
+
+def _run_batch_job(job: Tuple[str, str, str, dict[str,]]) -> Tuple[float, str, list[str]]:
+    """Rendering and saving a sheet in batch mode, returning time, error and filenames"""
+    (input_filename, sheet_name, output_name, settings) = job
+    start_time = time.perf_counter()
+    output_names = []
+    try:
+        renderer = Renderer(input_dir=os.path.dirname(input_filename),
+                            **settings["renderer"])
+        # the file is closed once the iterator is gone, so keep it until the end
+        sheets = iter_sheets(input_filename)
+        for (i, j) in sheets:
+            if i == sheet_name:
+                break
+        else:
+            raise NameError("Sheet not found")
+        (options, images) = renderer.render_sheet_output(
+            j, settings["page_height"], settings["output"])
+        output_dir = os.path.dirname(output_name)
+        ext = OUTPUT_FORMATS[options["format"]]
+        if os.path.splitext(output_name)[1] != ext:
+            # the style could not be loaded when the name was reserved
+            output_name = get_output_name(input_filename, sheet_name, output_dir, (), ext)
+        # pages are named after the name reserved, so they never collide with
+        # other sheets, and existing files are kept as in single file mode
+        reserved = set()
+        for (k, tmp_img) in enumerate(images, 1):
+            tmp_name = output_name
+            if settings["page_height"]:
+                tmp_name = get_output_name(output_name, "p" + str(k), output_dir,
+                                           reserved, ext)
+                reserved.add(tmp_name)
+            save_image(tmp_img, tmp_name, options)
+            output_names.append(tmp_name)
+        if not output_names:
+            raise NameError("Empty sheet")
+    except Exception as e: # one broken sheet should not stop the others
+        return (time.perf_counter() - start_time, "{}: {}".format(type(e).__name__, e),
+                output_names)
+    return (time.perf_counter() - start_time, None, output_names)
+
+
+def run_batch(paths: list[str], output_dir=None, jobs=1,
+              config_dir="config", style_cache=False, incremental=False,
+              tile_cache_dir=None, page_height=0, output_options=None) -> int:
+    """Rendering all sheets of many files, returning the number of failures
+
+    Files which can't be read are counted apart from the sheets failed.
+    """
+    start_time = time.perf_counter()
+    output_options = output_options or {}
+    batch_jobs = []
+    reserved = set()
+    failed = 0
+    failed_files = 0
+    for i in find_input_files(paths):
+        # names are reserved with the format of each style, which may override the default
+        renderer = Renderer(config_dir, os.path.dirname(i), style_cache=style_cache)
+        try:
+            sheets = [(j, get_sheet_ext(renderer, k, output_options))
+                      for (j, k) in iter_sheets(i)]
+        except Exception as e:
+            print("FAILED", i, "{}: {}".format(type(e).__name__, e))
+            failed_files += 1
+            continue
+        tmp_output_dir = os.path.dirname(i) if output_dir is None else output_dir
+        settings = {"renderer": {"config_dir": config_dir, "style_cache": style_cache},
+                    "page_height": page_height, "output": output_options}
+        if incremental:
+            settings["renderer"]["tile_cache_dir"] = tile_cache_dir or os.path.join(
+                tmp_output_dir, TILE_CACHE_DIRNAME)
+        for (j, ext) in sheets:
+            output_name = get_output_name(i, j, tmp_output_dir, reserved, ext)
+            reserved.add(output_name)
+            batch_jobs.append((i, j, output_name, settings))
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(jobs, _get_mp_context())
+        results = pool.map(_run_batch_job, batch_jobs)
+    else:
+        pool = None
+        results = map(_run_batch_job, batch_jobs)
+    for (job, (job_time, error, output_names)) in zip(batch_jobs, results):
+        if error is None:
+            print("{:8.2f}s".format(job_time), ", ".join(output_names), "DONE")
+        else:
+            print("{:8.2f}s".format(job_time), job[0], "[" + job[1] + "]", "FAILED", error)
+            failed += 1
+    if pool is not None:
+        pool.shutdown()
+    print("\n{} sheets, {} failed, {:.2f}s in total".format(
+        len(batch_jobs), failed, time.perf_counter() - start_time))
+    if failed_files:
+        print("{} files not read".format(failed_files))
+    return failed + failed_files
+
+
+def get_sheet_files(renderer: Renderer, style_name: str,
+                    rows: list[Tuple[str, list]]) -> set[str]:
+    """Getting the files a sheet depends on, as far as they can be found"""
+    ret = set()
+    try:
+        ret.add(os.path.abspath(find_style_file(style_name, renderer.config_dir)))
+        style = renderer.load_style(style_name)
+    except Exception: # the layout file is still watched until it is fixed
+        return ret
+    for i in style.layouts.values():
+        ret.add(os.path.abspath(i.background))
+        ret.update(os.path.abspath(j.conf["font"]) for j in i.items if "font" in j.conf)
+    ret.update(style.ctx.meta.get("figure_alias", {}).values())
+    # only cells of figures are looked up, as in TileCache
+    for (i, j) in rows:
+        if i not in style.layouts:
+            continue
+        for k in style.layouts[i].get_figure_cells():
+            if k < len(j) and isinstance(j[k], str) and j[k] != "":
+                try:
+                    ret.add(os.path.abspath(find_figure(j[k], style.ctx)))
+                except (KeyError, NameError):
+                    pass
+    return ret
+
+
+class PreviewServer:
+    """Serving the latest images of watch mode on a local HTTP port"""
+
+    def __init__(self, port: int):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        preview = self
+
+        class PreviewHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                preview.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.images = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), PreviewHandler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def get_url(self) -> str:
+        """Getting the URL of the index page"""
+        return "http://127.0.0.1:{}/".format(self.httpd.server_address[1])
+
+    def set_images(self, filenames: Iterable[str]):
+        """Setting the images to be served"""
+        with self.lock:
+            self.images = {os.path.basename(i): i for i in sorted(filenames)}
+            self.version += 1
+
+    def handle(self, request):
+        """Responding with the index page reloading itself, or an image"""
+        import html
+        import mimetypes
+        import urllib.parse
+        name = urllib.parse.unquote(urllib.parse.urlsplit(request.path).path.lstrip("/"))
+        with self.lock:
+            images = dict(self.images)
+            version = self.version
+        if name == "":
+            body = "".join(
+                "<h3>{0}</h3><img src=\"{1}?v={2}\" style=\"max-width: 100%\">".format(
+                    html.escape(i), urllib.parse.quote(i), version) for i in images)
+            body = ("<!DOCTYPE html><html><head><meta charset=\"utf-8\">"
+                    "<meta http-equiv=\"refresh\" content=\"2\"><title>HCTIWS</title>"
+                    "</head><body>" + (body or "No image yet") + "</body></html>").encode()
+            content_type = "text/html; charset=utf-8"
+        else:
+            try:
+                with open(images[name], "rb") as f:
+                    body = f.read()
+            except (KeyError, OSError):
+                request.send_error(404)
+                return
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        request.send_response(200)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        request.send_header("Cache-Control", "no-store")
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def watch_file(input_filename: str, output_dir: str, renderer: Renderer,
+               page_height=0, output_options=None, interval=1.0,
+               server: PreviewServer = None):
+    """Rendering sheets of the file again whenever they or their files change
+
+    The process keeps its caches between renderings, and only the sheets
+    whose rows or files changed are rendered again, overwriting their images.
+    """
+    input_filename = os.path.abspath(input_filename)
+    states = {}
+    mtimes = {}
+    while True:
+        changed = {i for (i, j) in mtimes.items() if TileCache.get_mtime(i) != j}
+        if mtimes and not changed:
+            time.sleep(interval)
+            continue
+        mtimes = {i: TileCache.get_mtime(i) for i in mtimes}
+        mtimes[input_filename] = TileCache.get_mtime(input_filename)
+        if changed:
+            print("\nChanged:", ", ".join(sorted(changed)))
+            # styles are cached by mtime, but assets and fonts only by path
+            if any(i != input_filename and not i.endswith((".toml", ".ini"))
+                   for i in changed):
+                clear_caches()
+            _path_index.clear()
+        try:
+            sheets = read_sheets(input_filename)
+        except Exception as e:
+            print("FAILED", input_filename, "{}: {}".format(type(e).__name__, e))
+            continue
+        for i in list(states):
+            if i not in sheets:
+                del states[i]
+        for (i, s_sheet) in sheets.items():
+            import hashlib
+            digest = hashlib.sha256(json.dumps(s_sheet, default=str).encode()).hexdigest()
+            if i in states and states[i][0] == digest and not states[i][1] & changed:
+                continue
+            (style_name, rows) = parse_sheet(s_sheet)
+            rows = list(rows)
+            files = set() if style_name is None else get_sheet_files(renderer, style_name, rows)
+            reserved = set().union(*(j[2] for (k, j) in states.items() if k != i))
+            names = []
+            try:
+                (options, images) = renderer.render_sheet_output(
+                    s_sheet, page_height, output_options)
+                ext = OUTPUT_FORMATS[options["format"]]
+                for (j, tmp_img) in enumerate(images, 1):
+                    names.append(get_output_name(
+                        input_filename, i + "_p" + str(j) if page_height else i,
+                        output_dir, reserved, ext, overwrite=True))
+                    save_image(tmp_img, names[-1], options)
+                    print(names[-1], "DONE")
+            except Exception as e: # keep watching until the error is fixed
+                print("FAILED", "[" + i + "]", "{}: {}".format(type(e).__name__, e))
+            states[i] = (digest, files, names)
+            for j in files:
+                mtimes.setdefault(j, TileCache.get_mtime(j))
+        if server is not None:
+            server.set_images(j for i in states.values() for j in i[2])
+        print("Watching for changes, press Ctrl+C to stop")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Getting the parser of command line arguments"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="hctiws", description="HCTIWS Creates the Image with Sheets")
+    parser.add_argument("input_file", nargs="?", metavar="INPUT_FILE",
+                        help="spreadsheet file (.csv, .xlsx, .xls)")
+    parser.add_argument("output_dir", nargs="?", metavar="OUTPUT_DIRECTORY",
+                        help="directory of output images, "
+                        "defaults to the directory of INPUT_FILE")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="render with N processes (default: 1)")
+    parser.add_argument("-b", "--batch", nargs="+", metavar="PATH",
+                        help="render all spreadsheet files, directories or "
+                        "glob patterns given, with one job per sheet")
+    parser.add_argument("-d", "--output-dir", dest="batch_output_dir",
+                        metavar="OUTPUT_DIRECTORY",
+                        help="directory of output images in batch mode")
+    parser.add_argument("--style-cache", action="store_true",
+                        help="keep compiled styles in layout.toml.pickle "
+                        "next to each layout file")
+    parser.add_argument("-p", "--page-height", type=int, default=0, metavar="PIXELS",
+                        help="split each sheet between rows into numbered pages "
+                        "no higher than PIXELS, keeping one page in memory")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the image of the first sheet to FILE, "
+                        "or to stdout if FILE is -")
+    parser.add_argument("-f", "--format", choices=list(OUTPUT_FORMATS) + ["jpg"],
+                        help="format of output images, overriding the style "
+                        "(default: png)")
+    parser.add_argument("--compress-level", type=int, choices=range(10), metavar="0-9",
+                        help="zlib compression level of PNG, lower is faster")
+    parser.add_argument("--quality", type=int, metavar="1-100",
+                        help="quality of lossy WebP and JPEG")
+    parser.add_argument("--lossless", action="store_true", default=None,
+                        help="save WebP losslessly")
+    parser.add_argument("--colors", type=int, metavar="N",
+                        help="reduce output images to a palette of N colors")
+    parser.add_argument("--encode-jobs", type=int, default=1, metavar="N",
+                        help="save images with N background threads (default: 1)")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="reuse sections rendered by previous runs if "
+                        "their contents, style and files are unchanged")
+    parser.add_argument("--cache-dir", metavar="DIRECTORY",
+                        help="directory of sections kept by --incremental, "
+                        "defaults to " + TILE_CACHE_DIRNAME + " in the output directory")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="keep running and render the sheets again whenever "
+                        "the input file, layout files or assets change")
+    parser.add_argument("--interval", type=float, default=1.0, metavar="SECONDS",
+                        help="interval of checking files in watch mode (default: 1)")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="watch and preview the images at http://127.0.0.1:PORT/")
+    parser.add_argument("--profile", action="store_true",
+                        help="print the time of each stage, item type and the "
+                        "slowest rows, use with -j 1 to include rows")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="save the timings as a Chrome trace (JSON), "
+                        "viewable in chrome://tracing or Perfetto")
+    return parser
+
+
 def main(argv=None):
     """Main function of HCTIWS"""
-    global INPUT_DIR
     if argv is None:
         argv = sys.argv
+    parser = get_parser()
+    args = parser.parse_args(argv[1:])
+    clear_caches()
+    # the image is written to stdout, so are the messages not
+    log = sys.stderr if args.output == "-" else sys.stdout
     # display the version info
-    print("HCTIWS Creates the Image with Sheets")
-    print("       (C) ZMSOFT 2018-2025")
-    print("version 2.81-dev\n")
+    print("HCTIWS Creates the Image with Sheets", file=log)
+    print("       (C) ZMSOFT 2018-2025", file=log)
+    print("version 2.81-dev\n", file=log)
+    profiler = None
+    if args.profile or args.trace is not None:
+        profiler = Profiler()
+    with instrument(profiler):
+        ret = run_args(args, parser)
+    if args.profile:
+        print("\n" + profiler.get_summary(), file=log)
+    if args.trace is not None:
+        profiler.save_trace(args.trace)
+    return ret
+
+
+def run_args(args: argparse.Namespace, parser: argparse.ArgumentParser) -> int:
+    """Rendering with parsed command line arguments"""
+    output_options = {"format": args.format, "compress_level": args.compress_level,
+                      "quality": args.quality, "lossless": args.lossless,
+                      "colors": args.colors}
+    if args.batch is not None:
+        if args.watch or args.serve is not None:
+            parser.error("watch mode only accepts a single input file")
+        if args.output is not None:
+            parser.error("--output only accepts a single input file")
+        return 1 if run_batch(args.batch, args.batch_output_dir, args.jobs,
+                              style_cache=args.style_cache,
+                              incremental=args.incremental,
+                              tile_cache_dir=args.cache_dir,
+                              page_height=args.page_height,
+                              output_options=output_options) else 0
+    if args.output is not None:
+        if args.input_file is None or args.output_dir is not None:
+            parser.error("--output needs INPUT_FILE and no OUTPUT_DIRECTORY")
+        if args.watch or args.serve is not None or args.page_height:
+            parser.error("--output cannot be used with watch mode or --page-height")
+        # the extension decides the format unless it is given
+        ext = os.path.splitext(args.output)[1].lower()
+        if output_options["format"] is None and ext in (".png", ".webp", ".jpg", ".jpeg"):
+            output_options["format"] = ext[1:]
     # get input filename
-    if len(argv) == 1:
-        print("Usage: hctiws [INPUT_FILE [OUTPUT_DIRECTORY]]\n")
+    if args.input_file is None:
+        print(parser.format_usage())
         input_filename = input("Input file (.csv, .xlsx, .xls): ")
-        INPUT_DIR = os.path.dirname(input_filename)
-    elif len(argv) == 2:
-        input_filename = argv[1]
-        INPUT_DIR = os.path.dirname(input_filename)
+        input_dir = os.path.dirname(input_filename)
+    elif args.output_dir is None:
+        input_filename = args.input_file
+        input_dir = os.path.dirname(input_filename)
     else:
-        input_filename = argv[1]
-        INPUT_DIR = argv[2]
-    # open worksheet/sheet file
-    if input_filename[-4:] == ".csv":
-        content = read_csv_file(input_filename)
-    elif input_filename[-5:] == ".xlsx" or input_filename[-4:] == ".xls":
-        content = read_excel_file(input_filename)
-    # process and save the result of each sheet
-    for i in content:
-        tmp_img = process_sheet(content[i])
-        # tmp_img.show()  # show the image before saving for debug
-        tmp_name = os.path.join(
-            INPUT_DIR, valid_filename(
-                os.path.basename(input_filename)).
-            rsplit(".", 1)[0] + "_" + valid_filename(i))
-        if os.path.exists(tmp_name + ".png"):
-            for j in range(1, 100):
-                if not os.path.exists(tmp_name + "-" + str(j) + ".png"):
-                    tmp_name += "-" + str(j) + ".png"
-                    break
-            else:
-                raise NameError("Too many duplicated file names")
-        else:
-            tmp_name += ".png"
-        tmp_img.save(tmp_name, format="png") #, optimize=True) #compress_level=0)
-        print(tmp_name, "DONE")
+        input_filename = args.input_file
+        input_dir = args.output_dir
+    tile_cache_dir = None
+    if args.incremental:
+        tile_cache_dir = args.cache_dir or os.path.join(input_dir, TILE_CACHE_DIRNAME)
+    renderer = Renderer(input_dir=input_dir, jobs=args.jobs,
+                        style_cache=args.style_cache, tile_cache_dir=tile_cache_dir)
+    if args.output is not None:
+        if not write_file_output(input_filename, args.output, renderer, output_options):
+            print("FAILED", input_filename, "NameError: Empty sheet", file=sys.stderr)
+            return 1
+        return 0
+    if args.watch or args.serve is not None:
+        server = None
+        if args.serve is not None:
+            server = PreviewServer(args.serve)
+            print("Preview at", server.get_url())
+        try:
+            watch_file(input_filename, input_dir, renderer, args.page_height,
+                       output_options, args.interval, server)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    writer = ImageWriter(args.encode_jobs)
+    reserved = set()
+    # process and save the result of each sheet while reading the file,
+    # the next sheet is rendered while the previous one is being encoded
+    for (i, rows) in iter_sheets(input_filename):
+        (options, images) = renderer.render_sheet_output(rows, args.page_height,
+                                                         output_options)
+        ext = OUTPUT_FORMATS[options["format"]]
+        for (j, tmp_img) in enumerate(images, 1):
+            # tmp_img.show()  # show the image before saving for debug
+            tmp_name = get_output_name(
+                input_filename, i + "_p" + str(j) if args.page_height else i,
+                input_dir, reserved, ext)
+            reserved.add(tmp_name)
+            for k in writer.save(tmp_img, tmp_name, options):
+                print(k, "DONE")
+    for k in writer.close():
+        print(k, "DONE")
     return 0
 
 
-INPUT_DIR = ""
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,168 @@
+"""Regression tests of HCTIWS, run with python -m pytest or python -m unittest"""
+
+import sys
+import os
+import json
+import random
+import subprocess
+import tempfile
+import unittest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import benchmark
+import hctiws
+
+
+def prepare_style(workdir: str) -> str:
+    """Generating a style of a single text item, returning its name"""
+    from PIL import Image
+    font_file = benchmark.find_font(workdir)
+    style_dir = os.path.join(workdir, "config", "test")
+    os.makedirs(style_dir, exist_ok=True)
+    Image.new("RGB", (400, 40), "white").save(os.path.join(style_dir, "bg.png"))
+    with open(os.path.join(style_dir, "layout.toml"), "w") as f:
+        f.write("[_meta]\nmax_width = 400\n\n[row]\nbackground = \"bg.png\"\n")
+        f.write("[row.default_text]\nfont = {}\ncolor = \"black\"\n".format(
+            json.dumps(font_file)))
+        f.write("horizontal_align = \"left\"\nvertical_align = \"center\"\n")
+        f.write("[[row.item]]\ntype = \"text\"\nposition = [5, 5]\n"
+                "width = 390\nheight = 30\n")
+    return "test"
+
+
+class CommandLineTest(unittest.TestCase):
+    """Running the command line in a new process"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.workdir = self.tmp_dir.name
+        self.style = prepare_style(self.workdir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_hctiws(self, *args: str) -> subprocess.CompletedProcess:
+        """Running hctiws in the working directory, failing if it hangs"""
+        return subprocess.run(
+            [sys.executable, os.path.join(BASE_DIR, "hctiws.py")] + list(args),
+            cwd=self.workdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            timeout=60)
+
+    def test_multiple_sheets_with_jobs(self):
+        # the process pool of a sheet used to be forked while the previous
+        # sheet was being saved by a thread, which could hang the worker
+        try:
+            import openpyxl
+        except ImportError:
+            self.skipTest("openpyxl is not installed")
+        book = openpyxl.Workbook()
+        book.active.title = "first"
+        book.create_sheet("second")
+        for sheet in book.worksheets:
+            sheet.append([self.style])
+            for i in range(20):
+                sheet.append(["row", "{} {}".format(sheet.title, i)])
+        book.save(os.path.join(self.workdir, "book.xlsx"))
+        for _ in range(10):
+            ret = self.run_hctiws("book.xlsx", "-j", "2")
+            self.assertEqual(ret.returncode, 0, ret.stderr.decode())
+        self.assertTrue(os.path.exists(os.path.join(self.workdir, "book_first.png")))
+        self.assertTrue(os.path.exists(os.path.join(self.workdir, "book_second.png")))
+
+
+class RendererTest(unittest.TestCase):
+    """Rendering sheets in the same process"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.workdir = self.tmp_dir.name
+        self.style = prepare_style(self.workdir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def render(self, s_sheet: list[list], **kwargs) -> bytes:
+        """Rendering the sheet into PNG data with a new renderer"""
+        renderer = hctiws.Renderer(os.path.join(self.workdir, "config"),
+                                   self.workdir, **kwargs)
+        return renderer.render_sheet_bytes(s_sheet, "png")
+
+    def test_same_output(self):
+        # parallel rendering, cached tiles and repeated rows are all expected
+        # to give the same image as rendering every row in order
+        s_sheet = [[self.style]]
+        for i in range(30):
+            s_sheet.append(["row", "line {}".format(i % 7)])
+        expected = self.render(s_sheet, jobs=1)
+        self.assertEqual(self.render(s_sheet, jobs=2), expected)
+        tile_cache_dir = os.path.join(self.workdir, "tiles")
+        # the first run fills the tile cache and the second one reads it
+        self.assertEqual(self.render(s_sheet, tile_cache_dir=tile_cache_dir), expected)
+        self.assertTrue(os.listdir(tile_cache_dir))
+        self.assertEqual(self.render(s_sheet, tile_cache_dir=tile_cache_dir), expected)
+
+
+def fit_doubletext_linear(major: str, minor: str, font: str, width: int, height: int,
+                          space: int, minimum_point: int, minimum_diff: int,
+                          maximum_diff: int) -> tuple[int, int]:
+    """Getting the sizes of both texts of 'doubletext' one point at a time, as before"""
+    def fit_linear(text: str, text_width: int) -> int:
+        size = height
+        while size > 1 and hctiws.get_text_extent(text, font, size)[0] > text_width:
+            size -= 1
+        return size
+
+    major_size = fit_linear(major, width)
+    minor_size = fit_linear(minor, width - hctiws.get_text_extent(
+        major, font, major_size)[0] - space)
+    while minor_size < minimum_point or major_size - minor_size > maximum_diff:
+        major_size -= 1
+        if major_size < 1:
+            raise NameError("\"{}\" and \"{}\" can't fit in doubletext".format(
+                major, minor))
+        minor_size = fit_linear(minor, width - hctiws.get_text_extent(
+            major, font, major_size)[0] - space)
+    if major_size - minor_size <= minimum_diff:
+        minor_size = max(minimum_point, major_size - minimum_diff)
+    return (major_size, minor_size)
+
+
+class FitDoubletextTest(unittest.TestCase):
+    """Comparing the bisection of doubletext sizes with the linear search"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.font_file = benchmark.find_font(self.tmp_dir.name)
+
+    def tearDown(self):
+        hctiws.fit_doubletext.cache_clear()
+        self.tmp_dir.cleanup()
+
+    def test_same_as_linear(self):
+        rand = random.Random(2018)
+        letters = "abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+        for _ in range(300):
+            args = ("".join(rand.choice(letters) for _ in range(rand.randint(1, 20))),
+                    "".join(rand.choice(letters) for _ in range(rand.randint(1, 20))),
+                    self.font_file, rand.randint(20, 300), rand.randint(5, 40),
+                    rand.randint(0, 10), rand.randint(1, 12), rand.randint(0, 6),
+                    rand.randint(0, 20))
+            try:
+                expected = fit_doubletext_linear(*args)
+            except NameError:
+                with self.assertRaises(NameError, msg=repr(args)):
+                    hctiws.fit_doubletext(*args)
+                continue
+            self.assertEqual(hctiws.fit_doubletext(*args), expected, repr(args))
+
+    def test_cannot_fit(self):
+        # the minor text never reaches the minimum size beside the major one
+        with self.assertRaises(NameError):
+            hctiws.fit_doubletext("major text", "minor text", self.font_file,
+                                  30, 20, 5, 10, 0, 20)
+
+
+if __name__ == "__main__":
+    unittest.main()